@@ -37,11 +37,20 @@ CHANGELOG
 import argparse
 import os
 import signal
+import sys
 
-from ccdl.apps import download_adobe_app
-from ccdl.net import set_cache_dir, set_header_auth
-from ccdl.prod import get_products, get_platforms
-from ccdl.utils import question_y
+from ccdl.apps import download_adobe_app, watch_products
+from ccdl.archive import check_archive_format
+from ccdl.cache import import_installers
+from ccdl.catalog import format_query_result
+from ccdl.daemon import serve_daemon
+from ccdl.distributed import run_worker, set_coordinator
+from ccdl.net import set_cache_dir, set_catalog_ttl, set_header_auth, set_progress_bar
+from ccdl.packages import request_stop, set_ignore_space, set_pipeline_jobs
+from ccdl.prod import get_known_platforms, get_products, get_targets, get_targets_platforms, get_url_version, \
+    load_products
+from ccdl.storage import set_store
+from ccdl.utils import CcdlError, question_y, split_list
 
 VERSION_STR = '0.3.0'
 
@@ -54,22 +63,25 @@ def show_version():
 
 
 def handler(signum, param):
+    if request_stop():
+        print('\nUser break, finishing packages in progress, the build resumes when run again. '
+              'Press Ctrl-C again to exit now')
+        return
     print('\nUser break, exit')
     exit(0)
 
 
 if __name__ == '__main__':
-    show_version()
-
     parser = argparse.ArgumentParser()
     parser.add_argument('-u', '--url_version',
                         help="Get app info from v4/v5/v6 url (eg. v6)", action='store')
     parser.add_argument('-o', '--os',
-                        help='Set the target Operation System', action='store')
+                        help='Set the target Operation Systems separated by comma (eg. darwin,windows)',
+                        action='store')
     parser.add_argument('-a', '--arch',
-                        help='Set the architecture to download', action='store')
+                        help='Set the architectures to download separated by comma (eg. arm64,x64)', action='store')
     parser.add_argument('-l', '--language',
-                        help='Language code (eg. en_US) or ALL', action='store')
+                        help='Language codes separated by comma (eg. en_US,de_DE) or ALL', action='store')
     parser.add_argument('-s', '--sap_code',
                         help='SAP code for desired product (eg. PHSP)', action='store')
     parser.add_argument('-v', '--app_version',
@@ -84,26 +96,194 @@ if __name__ == '__main__':
                         help='Build GUI for installer', action='store_true')
     parser.add_argument('-i', '--icon',
                         help='Icon file of installer in GUI mode, else use Creative Cloud icon', action='store')
+    parser.add_argument('-r', '--archive',
+                        help='Write installer to a single zip or tar.zst archive in target directory',
+                        action='store', choices=['zip', 'tar.zst'])
     parser.add_argument('-q', '--no_repeat_prompt',
                         help="Don't prompt for additional downloads", action='store_true')
+    parser.add_argument('--download_jobs',
+                        help='Concurrent package downloads, default 1', action='store', type=int, default=1)
+    parser.add_argument('--verify_jobs',
+                        help='Concurrent package verifications, default 1', action='store', type=int, default=1)
+    parser.add_argument('--materialize_jobs',
+                        help='Concurrent package copies into installer, default 1', action='store', type=int,
+                        default=1)
+    parser.add_argument('--queue_size',
+                        help='Packages waiting between pipeline stages, default 4', action='store', type=int,
+                        default=4)
+    parser.add_argument('--ignore_space',
+                        help='Only warn if disk space looks insufficient', action='store_true')
+    parser.add_argument('--ttl',
+                        help='Seconds before cached products xml is refreshed, default never', action='store', type=int)
+    parser.add_argument('--store',
+                        help='Store shared by build agents, a folder or s3://bucket/prefix, the cache folder '
+                             'keeps local copies unless --store_evict', action='store')
+    parser.add_argument('--store_endpoint',
+                        help='Endpoint of S3 compatible store (eg. http://127.0.0.1:9000)', action='store')
+    parser.add_argument('--store_jobs',
+                        help='Concurrent parts of one store transfer, default 4', action='store', type=int,
+                        default=4)
+    parser.add_argument('--store_evict',
+                        help='Remove packages of a finished build from the cache folder if the store holds them, '
+                             'the cache folder must not be used by other builds at the same time',
+                        action='store_true')
+    subparsers = parser.add_subparsers(dest='command')
+    watch_parser = subparsers.add_parser('watch', help='Periodically refresh catalog and prefetch new versions')
+    watch_parser.add_argument('--interval',
+                              help='Seconds between catalog refreshes, default 3600', action='store', type=int,
+                              default=3600)
+    watch_parser.add_argument('--pin',
+                              help='Comma separated SAP codes whose new versions are prefetched (eg. PHSP,ILST)',
+                              action='store')
+    query_parser = subparsers.add_parser('query', help='Query the catalog and print matching builds')
+    query_parser.add_argument('--sap',
+                              help='Comma separated SAP codes (eg. PHSP,ILST)', action='store')
+    query_parser.add_argument('--name',
+                              help='Substring of product display name, case insensitive', action='store')
+    query_parser.add_argument('--platform',
+                              help='Comma separated platforms (eg. win64,macarm64)', action='store')
+    query_parser.add_argument('--locale',
+                              help='Comma separated locales that must all be supported (eg. ja_JP)', action='store')
+    query_parser.add_argument('--min_version',
+                              help='Lowest product version to include', action='store')
+    query_parser.add_argument('--max_version',
+                              help='Highest product version to include', action='store')
+    query_parser.add_argument('--latest',
+                              help='Only the latest version per SAP code and platform', action='store_true')
+    query_parser.add_argument('--hidden',
+                              help='Include products hidden from Creative Cloud', action='store_true')
+    query_parser.add_argument('--format',
+                              help='Output format, default json', action='store', choices=['json', 'tsv'],
+                              default='json')
+    daemon_parser = subparsers.add_parser('daemon', help='Serve a build job API with the catalog kept in memory')
+    daemon_parser.add_argument('--listen',
+                               help='HTTP address to listen on, default 127.0.0.1:8765', action='store',
+                               default='127.0.0.1:8765')
+    daemon_parser.add_argument('--socket',
+                               help='Listen on this unix socket instead of HTTP address', action='store')
+    daemon_parser.add_argument('--jobs',
+                               help='Build jobs running at the same time, default 1', action='store', type=int,
+                               default=1)
+    daemon_parser.add_argument('--keep_jobs',
+                               help='Finished jobs kept with their log, older ones are dropped, default 100',
+                               action='store', type=int, default=100)
+    cache_parser = subparsers.add_parser('cache', help='Maintain the cache folder')
+    cache_subparsers = cache_parser.add_subparsers(dest='cache_command', required=True)
+    import_parser = cache_subparsers.add_parser('import',
+                                                help='Link packages of installer folders into the cache, '
+                                                     'verified by --verify_jobs threads')
+    import_parser.add_argument('dir', help='Folder searched for installers')
+    coordinator_parser = subparsers.add_parser('coordinator',
+                                               help='Build as usual, with packages fetched by worker processes')
+    coordinator_parser.add_argument('--listen',
+                                    help='HTTP address workers connect to, default 127.0.0.1:8766', action='store',
+                                    default='127.0.0.1:8766')
+    coordinator_parser.add_argument('--lease',
+                                    help='Seconds a worker holds a package without renewing, default 300',
+                                    action='store', type=int, default=300)
+    coordinator_parser.add_argument('--attempts',
+                                    help='Failed attempts before a package is given up, default 3', action='store',
+                                    type=int, default=3)
+    worker_parser = subparsers.add_parser('worker', help='Fetch packages handed out by a coordinator into the store')
+    worker_parser.add_argument('--coordinator',
+                               help='URL of the coordinator (eg. http://10.0.0.1:8766)', action='store',
+                               required=True)
+    worker_parser.add_argument('--name',
+                               help='Worker name shown by coordinator, default host-pid', action='store')
     args = parser.parse_args()
 
+    if args.command == 'query':
+        # Keep stdout for the query result only
+        sys.stdout = sys.stderr
+    show_version()
+
     if args.icon and not os.path.isfile(args.icon):
         print('Icon file not found: ' + args.icon)
         exit(1)
 
+    if args.store and not args.cache:
+        print('Store requires a cache folder')
+        exit(1)
+    if args.store_evict and not args.store:
+        print('Store eviction requires a store')
+        exit(1)
+
+    if args.archive:
+        if not args.cache or not args.target:
+            print('Archive output requires cache folder and target directory')
+            exit(1)
+        if args.gui:
+            print('GUI for installer not supported in archive output')
+            exit(1)
+        try:
+            check_archive_format(args.archive)
+        except CcdlError as e:
+            print(e)
+            exit(1)
+
     if args.cache:
         set_cache_dir(args.cache)
     if args.auth:
         set_header_auth(args.auth)
+    if args.ttl is not None:
+        set_catalog_ttl(args.ttl)
+    set_pipeline_jobs(args.download_jobs, args.verify_jobs, args.materialize_jobs, args.queue_size)
+    set_ignore_space(args.ignore_space)
     if args.sap_code and args.app_version:
         args.no_repeat_prompt = True
 
-    all_platforms, allowed_platforms = get_platforms(args.os, args.arch)
-    products, sap_codes = get_products(all_platforms, allowed_platforms, args)
-    signal.signal(signal.SIGINT, handler)
+    try:
+        if args.store:
+            set_store(args.store, args.store_endpoint, args.store_jobs, args.store_evict)
+        if args.command == 'cache':
+            if not args.cache:
+                print('Cache command requires a cache folder')
+                exit(1)
+            import_installers(args.dir, args.verify_jobs)
+            exit(0)
+        if args.command == 'worker':
+            if not args.cache:
+                print('Worker requires a cache folder')
+                exit(1)
+            set_progress_bar(False)
+            run_worker(args.coordinator, args.download_jobs, args.name)
+            exit(0)
+        if args.command == 'query':
+            # Every platform whatever the host OS, --platform filters
+            known_platforms = get_known_platforms()
+            catalog = load_products(get_url_version(args.url_version), known_platforms, known_platforms)
+            builds = catalog.query(sap_codes=split_list(args.sap, upper=True), name=args.name,
+                                   platforms=split_list(args.platform), locales=split_list(args.locale),
+                                   min_version=args.min_version, max_version=args.max_version, latest=args.latest,
+                                   include_hidden=args.hidden)
+            print('{} builds matched'.format(len(builds)))
+            sys.__stdout__.write(format_query_result(catalog, builds, args.format) + '\n')
+            exit(0)
+        if args.command == 'coordinator':
+            set_coordinator(args.listen, args.lease, args.attempts)
+
+        all_platforms, targets = get_targets(args.os, args.arch)
+        allowed_platforms = get_targets_platforms(targets)
+        if args.command == 'watch':
+            if not args.cache:
+                print('Watch mode requires a cache folder')
+                exit(1)
+            signal.signal(signal.SIGINT, handler)
+            watch_products(get_url_version(args.url_version), all_platforms, targets, args)
+        if args.command == 'daemon':
+            if not args.cache:
+                print('Daemon mode requires a cache folder')
+                exit(1)
+            signal.signal(signal.SIGINT, handler)
+            serve_daemon(get_url_version(args.url_version or 'v6'), all_platforms, targets, args)
 
-    while True:
-        download_adobe_app(products, sap_codes, allowed_platforms, args)
-        if args.no_repeat_prompt or not question_y('\nCreate another package'):
-            break
+        products, sap_codes = get_products(all_platforms, allowed_platforms, args)
+        signal.signal(signal.SIGINT, handler)
+
+        while True:
+            download_adobe_app(products, sap_codes, targets, args)
+            if args.no_repeat_prompt or not question_y('\nCreate another package'):
+                break
+    except CcdlError as e:
+        print(e)
+        exit(1)
@@ -4,19 +4,19 @@ from ccdl.net import fetch_file, fetch_app_xml
 from ccdl.utils import get_download_path
 
 
-def download_acrobat(app_info, args):
+def download_acrobat(app_info, target):
     """Download APRO"""
-    manifest = fetch_app_xml(app_info['buildGuid'])
+    manifest = fetch_app_xml(app_info.build_guid)
     download_url = manifest.find('asset_list/asset/asset_path').text
 
-    sap_code = app_info['sapCode']
-    version = app_info['productVersion']
-    name = '{}_{}_{}.dmg'.format(sap_code, version, app_info['apPlatform'])
+    sap_code = app_info.sap_code
+    version = app_info.product_version
+    name = '{}_{}_{}.dmg'.format(sap_code, version, app_info.ap_platform)
 
     print('\nsapCode: ' + sap_code)
     print('version: ' + version)
     print('installLanguage: ' + 'ALL')
-    app_path = get_download_path(args.target)
+    app_path = get_download_path(target)
     if app_path:
         print('destination: ' + os.path.join(app_path, name))
 
@@ -2,27 +2,167 @@ import json
 import locale
 import os
 import platform
+import time
 
 from ccdl.acrobat import download_acrobat
+from ccdl.archive import get_archive_path, get_installer_base_path, write_installer_archive
+from ccdl.cache import get_package_size, save_package_index
+from ccdl.distributed import distribute_packages
+from ccdl.journal import open_build_journal
 from ccdl.mac import create_mac_installer as create_mac_installer
-from ccdl.net import fetch_application_json, fetch_file
-from ccdl.prod import save_driver_xml
-from ccdl.utils import get_download_path
+from ccdl.net import fetch_application_json
+from ccdl.packages import evict_packages, fetch_packages
+from ccdl.catalog import version_key
+from ccdl.prod import forget_snapshot_versions, get_driver_xml, get_targets_platforms, refresh_products, \
+    save_driver_xml
+from ccdl.selection import load_selection_index, select_positions
+from ccdl.utils import DRIVER_XML_NAME, CcdlError, get_download_path, sync_pending_files
 from ccdl.win import create_win_installer as create_win_installer
 
 
+def get_target_os(target_os):
+    return (platform.system() if target_os is None else target_os).lower()
+
+
 def create_installer(app_name, dest, target_os, use_gui, icon_path):
-    target_os = (platform.system() if target_os is None else target_os).lower()
+    target_os = get_target_os(target_os)
     if target_os == 'darwin':
         return create_mac_installer(app_name, dest, use_gui, icon_path)
     elif target_os == 'windows':
         return create_win_installer(app_name, dest, use_gui, icon_path)
     else:
-        print('Unsupported target OS platform: ' + target_os)
-        exit(1)
+        raise CcdlError('Unsupported target OS platform: ' + target_os)
+
+
+def get_products_to_download(products, prod_info, allowed_platforms):
+    """Resolve the product and its dependencies to build guids"""
+    prods_to_download = []
+    for d_sap, d_version in prod_info.dependencies:
+        first_guid = build_guid = None
+        for v in products[d_sap].versions(allowed_platforms).values():
+            if v.base_version == d_version:
+                if not first_guid:
+                    first_guid = v.build_guid
+                if v.ap_platform in allowed_platforms:
+                    build_guid = v.build_guid
+                    break
+        if not build_guid:
+            build_guid = first_guid
+        prods_to_download.append({'sapCode': d_sap, 'version': d_version, 'buildGuid': build_guid})
+    prods_to_download.insert(
+        0, {'sapCode': prod_info.sap_code, 'version': prod_info.product_version, 'buildGuid': prod_info.build_guid})
+    return prods_to_download
+
+
+def select_packages(app_json, index, app_langs, s, v):
+    """Select packages per install language, return the union and {language: set of paths}"""
+    packages = app_json['Packages']['Package']
+    lang_positions = {app_lang: select_positions(index, app_lang) for app_lang in app_langs}
+    positions = sorted(set().union(*lang_positions.values()))
+    core_pkg_count = len(set(index['core']).intersection(positions))
+    print('[{}_{}] Selected {} core packages and {} non-core packages'.format(
+        s, v, core_pkg_count, len(positions) - core_pkg_count))
+    lang_paths = {app_lang: set(packages[i]['Path'] for i in p) for app_lang, p in lang_positions.items()}
+    return [packages[i] for i in positions], lang_paths
+
+
+def add_package_items(items, pkgs, s, v, product_dirs_of=None):
+    """Merge packages into {path: item}, packages shared by several builds are fetched once"""
+    for pkg in pkgs:
+        product_dirs = product_dirs_of(pkg) if product_dirs_of else []
+        item = items.get(pkg['Path'])
+        if item is None:
+            items[pkg['Path']] = {'sapCode': s, 'version': v, 'pkg': pkg, 'product_dirs': product_dirs}
+        else:
+            item['product_dirs'].extend(d for d in product_dirs if d not in item['product_dirs'])
+
+
+def get_target_builds(product, version, targets):
+    """Build of version for each target, skipping targets without it and duplicated builds
+
+    A single target keeps the build even if it is not on an allowed platform, like picking a version does.
+    """
+    builds = []
+    for target_os, platforms in targets:
+        prod_info = product.versions(platforms).get(version)
+        if prod_info is None:
+            continue
+        if len(targets) > 1 and (not prod_info.build_guid or prod_info.ap_platform not in platforms):
+            print('{} {} not available for {} {}, skipped'.format(
+                product.display_name, version, target_os, ', '.join(platforms)))
+            continue
+        if any(b[2] is prod_info for b in builds):
+            continue
+        builds.append((target_os, platforms, prod_info))
+    return builds
+
+
+def prefetch_adobe_app(products, sap_code, version, targets, app_langs=('ALL',)):
+    """Retrieve packages of a product version into cache without building installer"""
+    print('[{}_{}] Prefetching, install_language: {}'.format(sap_code, version, ', '.join(app_langs)))
+    builds = get_target_builds(products[sap_code], version, targets)
+    if sap_code == 'APRO':
+        for _, _, prod_info in builds:
+            download_acrobat(prod_info, None)
+        return
+
+    items = {}
+    app_jsons = {}
+    for _, platforms, prod_info in builds:
+        for p in get_products_to_download(products, prod_info, platforms):
+            s, v, guid = p['sapCode'], p['version'], p['buildGuid']
+            if guid not in app_jsons:
+                print('[{}_{}] Retrieve application.json, guid={}'.format(s, v, guid))
+                app_jsons[guid] = fetch_application_json(guid)
+            app_json = app_jsons[guid]
+            index = load_selection_index(guid, app_json)
+            add_package_items(items, select_packages(app_json, index, app_langs, s, v)[0], s, v)
+    fetch_packages(list(items.values()))
+    save_package_index()
+    evict_packages(list(items.values()))
 
 
-def download_adobe_app(products, sap_codes, allowed_platforms, args):
+def parse_languages(val):
+    """Split comma separated language codes and normalize their case, e.g. 'en_us,de_de' -> ['en_US', 'de_DE']"""
+    app_langs = []
+    for lang in (val or '').split(','):
+        lang = lang.strip()
+        if len(lang) == 5:
+            lang = lang[0:2].lower() + lang[2] + lang[3:5].upper()
+        elif len(lang) == 3:
+            lang = lang.upper()
+        if lang and lang not in app_langs:
+            app_langs.append(lang)
+    return ['ALL'] if 'ALL' in app_langs else app_langs
+
+
+def watch_products(url_version, all_platforms, targets, args):
+    """Periodically refresh the catalog and prefetch new versions of pinned products"""
+    pins = [s.strip().upper() for s in args.pin.split(',') if s.strip()] if args.pin else []
+    app_langs = parse_languages(args.language) or ['ALL']
+    allowed_platforms = get_targets_platforms(targets)
+    snapshot = None
+    while True:
+        try:
+            catalog, snapshot, diff = refresh_products(url_version, all_platforms, allowed_platforms, snapshot, 'watch')
+        except CcdlError as e:
+            print('Catalog refresh failed: {}'.format(e))
+            diff = None
+        failed = []
+        for sap_code in pins:
+            for version in (diff or {}).get(sap_code, {}).get('added', []):
+                try:
+                    prefetch_adobe_app(catalog.products, sap_code, version, targets, app_langs)
+                except CcdlError as e:
+                    print('[{}_{}] Prefetch failed, retry on next refresh: {}'.format(sap_code, version, e))
+                    failed.append((sap_code, version))
+        if failed:
+            forget_snapshot_versions(snapshot, failed, url_version, allowed_platforms, 'watch')
+        print('Next refresh in {} seconds'.format(args.interval))
+        time.sleep(args.interval)
+
+
+def download_adobe_app(products, sap_codes, targets, args):
     """Run main execution"""
     sap_code = args.sap_code
     if not sap_code:
@@ -40,39 +180,46 @@ def download_adobe_app(products, sap_codes, allowed_platforms, args):
                 print('{} is not a valid SAP Code. Please use a value from the list above.'.format(val))
 
     product = products.get(sap_code)
-    version_products = product['versions']
+    views = [product.view(platforms) for _, platforms in targets]
     version = None
     if args.app_version:
-        if version_products.get(args.app_version):
+        if any(view.versions.get(args.app_version) for view in views):
             print('Using provided version: ' + args.app_version)
             version = args.app_version
         else:
             print('Provided version not found: ' + args.app_version)
 
     if not version:
-        last_v = None
-        for v in reversed(version_products.values()):
-            if v['buildGuid'] and v['apPlatform'] in allowed_platforms:
-                print('{} Platform: {} - {}'.format(product['displayName'], v['apPlatform'], v['productVersion']))
-                last_v = v['productVersion']
-        if last_v is None:
+        for view in views:
+            for v in view.sorted_versions:
+                print('{} Platform: {} - {}'.format(product.display_name, view.versions[v].ap_platform, v))
+        latest = [view.latest.product_version for view in views if view.latest]
+        if not latest:
             print('')
             return
+        last_v = max(latest, key=version_key)
 
         while version is None:
             val = input('Please enter the desired version. Nothing for ' + last_v + ': ') or last_v
-            if version_products.get(val):
+            if any(view.versions.get(val) for view in views):
                 version = val
             else:
                 print('{} is not a valid version. Please use a value from the list above.'.format(val))
     print('')
 
+    builds = get_target_builds(product, version, targets)
+    if not builds:
+        print('Version {} not available for any target'.format(version))
+        return
+
     if sap_code == 'APRO':
-        download_acrobat(version_products[version], args)
+        for _, _, prod_info in builds:
+            download_acrobat(prod_info, args.target)
         return
 
-    app_locales = version_products[version]['locale']
-    all_locales = app_locales.copy()
+    all_locales = []
+    for _, _, prod_info in builds:
+        all_locales.extend(lc for lc in prod_info.locales if lc not in all_locales)
     all_locales.append('ALL')
     print('Available languages: {}'.format(', '.join(all_locales)))
 
@@ -81,109 +228,140 @@ def download_adobe_app(products, sap_codes, allowed_platforms, args):
     if not os_lang:
         os_lang = 'en_US'
 
-    app_lang = args.language
-    if app_lang in all_locales:
-        print('Using provided language: ' + args.language)
+    app_langs = parse_languages(args.language)
+    if app_langs and all(lang in all_locales for lang in app_langs):
+        print('Using provided language: ' + ', '.join(app_langs))
     else:
-        if app_lang is not None:
+        if args.language is not None:
             print('Provided language not available: ' + args.language)
-        app_lang = None
-
-    while app_lang is None:
-        val = input(f'Please enter the desired install language, or nothing for [{os_lang}]: ') or os_lang
-        if len(val) == 5:
-            val = val[0:2].lower() + val[2] + val[3:5].upper()
-        elif len(val) == 3:
-            val = val.upper()
-        if val in all_locales:
-            app_lang = val
+        app_langs = None
+
+    while app_langs is None:
+        val = input(f'Please enter the desired install languages separated by comma, or nothing for [{os_lang}]: ') \
+              or os_lang
+        langs = parse_languages(val)
+        missing = [lang for lang in langs if lang not in all_locales]
+        if langs and not missing:
+            app_langs = langs
         else:
-            print('{} is not available. Please use a value from the list above.'.format(val))
+            print('{} is not available. Please use a value from the list above.'.format(', '.join(missing) or val))
 
     dest = get_download_path(args.target)
 
-    prod_info = version_products[version]
-    prods_to_download = []
-    dependencies = prod_info['dependencies']
-    for d in dependencies:
-        first_arch = first_guid = build_guid = None
-        for p in products[d['sapCode']]['versions']:
-            if products[d['sapCode']]['versions'][p]['baseVersion'] == d['version']:
-                if not first_guid:
-                    first_guid = products[d['sapCode']]['versions'][p]['buildGuid']
-                    first_arch = products[d['sapCode']]['versions'][p]['apPlatform']
-                if products[d['sapCode']]['versions'][p]['apPlatform'] in allowed_platforms:
-                    build_guid = products[d['sapCode']]['versions'][p]['buildGuid']
-                    break
-        if not build_guid:
-            build_guid = first_guid
-        prods_to_download.append({'sapCode': d['sapCode'], 'version': d['version'], 'buildGuid': build_guid})
-    prods_to_download.insert(
-        0,
-        {'sapCode': prod_info['sapCode'], 'version': prod_info['productVersion'], 'buildGuid': prod_info['buildGuid']})
-
-    ap_platform = prod_info['apPlatform']
-    print('sapCode: ' + sap_code)
-    print('version: ' + version)
-    print('install_language: ' + app_lang)
-    print(prods_to_download)
-    if args.target:
-        install_app_name = 'Install_{}_{}-{}-{}'.format(sap_code, version, app_lang, ap_platform)
-        print('\nCreating {}'.format(install_app_name))
-        app_base_path, install_app_path, products_dir = create_installer(
-            install_app_name, dest, args.os, args.gui, args.icon)
-        print('destination: ' + install_app_path)
+    installers = []
+    target_builds = []
+    for target_os, platforms, prod_info in builds:
+        ap_platform = prod_info.ap_platform
+        build = {'target_os': target_os, 'prod_info': prod_info, 'installers': [],
+                 'languages': [lang for lang in app_langs if lang == 'ALL' or lang in prod_info.locales],
+                 'prods': get_products_to_download(products, prod_info, platforms)}
+        target_builds.append(build)
+        print('sapCode: ' + sap_code)
+        print('version: ' + version)
+        print('platform: ' + ap_platform)
+        print('install_language: ' + ', '.join(build['languages']))
+        print(build['prods'])
+        if not args.target:
+            continue
+        for app_lang in build['languages']:
+            installer = {'language': app_lang, 'build': build,
+                         'name': 'Install_{}_{}-{}-{}'.format(sap_code, version, app_lang, ap_platform)}
+            print('\nCreating {}'.format(installer['name']))
+            if args.archive:
+                os.makedirs(dest, exist_ok=True)
+                installer['base_path'] = get_installer_base_path(target_os)
+                installer['path'] = get_archive_path(dest, installer['name'], args.archive)
+                installer['products_dir'] = None
+            else:
+                installer['base_path'], installer['path'], installer['products_dir'] = create_installer(
+                    installer['name'], dest, target_os, args.gui, args.icon)
+            print('destination: ' + installer['path'])
+            build['installers'].append(installer)
+            installers.append(installer)
 
-    print('Preparing...')
-    for p in prods_to_download:
-        s, v = p['sapCode'], p['version']
+    journal = open_build_journal({
+        'sapCode': sap_code, 'version': version, 'languages': app_langs, 'archive': args.archive,
+        'targets': [[b['target_os'], b['prod_info'].ap_platform] for b in target_builds],
+        'dest': os.path.abspath(dest) if dest else None})
+    try:
+        build_installers(product, target_builds, installers, dest, args.archive, journal)
+    finally:
+        if journal:
+            journal.close()
 
-        print('[{}_{}] Retrieve application.json, guid={}'.format(s, v, p['buildGuid']))
-        p['application_json'] = fetch_application_json(p['buildGuid'])
 
-        if args.target is None:
-            continue
+def build_installers(product, target_builds, installers, dest, archive_format, journal=None):
+    """Retrieve packages of target builds into cache and installers, then finalize each installer"""
+    print('Preparing...')
+    app_jsons = {}
+    for build in target_builds:
+        dir_installers = [i for i in build['installers'] if i['products_dir']]
+        for p in build['prods']:
+            s, v, guid = p['sapCode'], p['version'], p['buildGuid']
+
+            if guid not in app_jsons:
+                print('[{}_{}] Retrieve application.json, guid={}'.format(s, v, guid))
+                app_jsons[guid] = fetch_application_json(guid)
+            p['application_json'] = app_jsons[guid]
 
-        print('[{}_{}] Creating folder for product'.format(s, v))
-        product_dir = os.path.join(products_dir, s)
-        app_json_path = os.path.join(product_dir, 'application.json')
-        os.makedirs(product_dir, exist_ok=True)
+            for installer in dir_installers:
+                print('[{}_{}] Creating folder for product in {}'.format(s, v, installer['name']))
+                product_dir = os.path.join(installer['products_dir'], s)
+                app_json_path = os.path.join(product_dir, 'application.json')
+                os.makedirs(product_dir, exist_ok=True)
 
-        print('[{}_{}] Saving application.json'.format(s, v))
-        with open(app_json_path, 'w') as file:
-            json.dump(p['application_json'], file, separators=(',', ':'))
+                print('[{}_{}] Saving application.json'.format(s, v))
+                with open(app_json_path, 'w') as file:
+                    json.dump(p['application_json'], file, separators=(',', ':'))
+    sync_pending_files()
 
     print('Downloading...')
 
-    for p in prods_to_download:
-        s, v = p['sapCode'], p['version']
-        app_json = p['application_json']
-
-        print('[{}_{}] Parsing available packages'.format(s, v))
-        core_pkg_count = 0
-        non_core_pkg_count = 0
-        packages = app_json['Packages']['Package']
-        download_paths = []
-        for pkg in packages:
-            if pkg.get('Type') and pkg['Type'] == 'core':
-                core_pkg_count += 1
-                download_paths.append(pkg['Path'])
-            else:
-                if app_lang == "ALL":
-                    non_core_pkg_count += 1
-                    download_paths.append(pkg['Path'])
-                elif (not pkg.get('Condition')) or app_lang in pkg['Condition']:
-                    non_core_pkg_count += 1
-                    download_paths.append(pkg['Path'])
-        print('[{}_{}] Selected {} core packages and {} non-core packages'.format(
-            s, v, core_pkg_count, non_core_pkg_count))
-
-        product_dir = os.path.join(products_dir, s) if args.target else None
-        for path in download_paths:
-            fetch_file(path, product_dir, s, v)
+    items = {}
+    archive_bytes = 0
+    for build in target_builds:
+        dir_installers = [i for i in build['installers'] if i['products_dir']]
+        for p in build['prods']:
+            s, v = p['sapCode'], p['version']
+            app_json = p['application_json']
+
+            print('[{}_{}] Parsing available packages'.format(s, v))
+            index = load_selection_index(p['buildGuid'], app_json)
+            p['packages'], p['language_paths'] = select_packages(app_json, index, build['languages'], s, v)
+
+            def product_dirs_of(pkg):
+                return [os.path.join(i['products_dir'], s) for i in dir_installers
+                        if pkg['Path'] in p['language_paths'][i['language']]]
 
+            add_package_items(items, p['packages'], s, v, product_dirs_of)
+            if archive_format:
+                archive_bytes += sum(get_package_size(pkg) for pkg in p['packages'] for i in build['installers']
+                                     if pkg['Path'] in p['language_paths'][i['language']])
+
+    distribute_packages(list(items.values()), journal)
+    fetch_packages(list(items.values()), dest if archive_format else None, archive_bytes, journal)
+    save_package_index()
     print('Package retrieve finished.')
 
-    if args.target:
-        save_driver_xml(app_base_path, products_dir, product, prod_info, ap_platform, app_lang)
-        print('\nPackage successfully created. Run {} to install.'.format(install_app_path))
+    for installer in installers:
+        app_lang = installer['language']
+        build = installer['build']
+        prod_info = build['prod_info']
+        output_path = installer['path'] if archive_format else os.path.join(installer['products_dir'], DRIVER_XML_NAME)
+        if journal and journal.done('installer', output_path):
+            print('\n{} already created, skipping'.format(installer['path']))
+            continue
+        if archive_format:
+            driver_xml = get_driver_xml(installer['base_path'], product, prod_info, prod_info.ap_platform, app_lang)
+            prods = [dict(p, packages=[pkg for pkg in p['packages'] if pkg['Path'] in p['language_paths'][app_lang]])
+                     for p in build['prods']]
+            write_installer_archive(installer['path'], archive_format, installer['name'], build['target_os'],
+                                    prods, driver_xml)
+            print('\nPackage successfully created. Extract {} and run its install script.'.format(installer['path']))
+        else:
+            save_driver_xml(installer['base_path'], installer['products_dir'], product, prod_info,
+                            prod_info.ap_platform, app_lang)
+            print('\nPackage successfully created. Run {} to install.'.format(installer['path']))
+        if journal:
+            journal.record('installer', output_path)
+    evict_packages(list(items.values()))
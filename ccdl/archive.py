@@ -0,0 +1,136 @@
+import io
+import json
+import os
+import stat
+import tarfile
+import time
+import zipfile
+
+from ccdl.mac import APPLICATIONS_PATH as MAC_APPLICATIONS_PATH
+from ccdl.mac import INSTALLER_SCRIPT as MAC_INSTALLER_SCRIPT
+from ccdl.mac import SCRIPT_NAME as MAC_SCRIPT_NAME
+from ccdl.net import get_cache_product_file, get_file_path, get_url_file_name
+from ccdl.utils import DRIVER_XML_NAME, CcdlError, commit_file, get_part_path, sync_pending_files
+from ccdl.win import APPLICATIONS_PATH as WIN_APPLICATIONS_PATH
+from ccdl.win import INSTALLER_SCRIPT as WIN_INSTALLER_SCRIPT
+from ccdl.win import SCRIPT_NAME as WIN_SCRIPT_NAME
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+ARCHIVE_FORMATS = {'zip': '.zip', 'tar.zst': '.tar.zst'}
+SCRIPT_MODE = stat.S_IRWXU | stat.S_IRGRP | stat.S_IXGRP | stat.S_IROTH | stat.S_IXOTH
+FILE_MODE = stat.S_IRUSR | stat.S_IWUSR | stat.S_IRGRP | stat.S_IROTH
+
+
+def check_archive_format(archive_format):
+    """Fail before any package is downloaded if the archive cannot be written"""
+    if archive_format not in ARCHIVE_FORMATS:
+        raise CcdlError('Unsupported archive format: ' + archive_format)
+    if archive_format == 'tar.zst' and zstandard is None:
+        raise CcdlError('Python module zstandard is required for tar.zst archive')
+
+
+class ZipArchiveWriter:
+    """Zip archive with all members stored, package zips are not recompressed"""
+
+    def __init__(self, path):
+        self.file = open(path, 'wb')
+        self.zip = zipfile.ZipFile(self.file, 'w', compression=zipfile.ZIP_STORED, allowZip64=True)
+
+    def add_bytes(self, name, data, mode=FILE_MODE):
+        info = zipfile.ZipInfo(name, date_time=time.localtime()[:6])
+        info.external_attr = (stat.S_IFREG | mode) << 16
+        self.zip.writestr(info, data)
+
+    def add_file(self, name, path):
+        self.zip.write(path, name)
+
+    def close(self):
+        self.zip.close()
+        self.file.close()
+
+    def discard(self):
+        try:
+            self.zip.close()
+        except (OSError, ValueError):
+            pass
+        self.file.close()
+
+
+class TarZstArchiveWriter:
+    """Tar stream compressed by zstd while it is written"""
+
+    def __init__(self, path):
+        check_archive_format('tar.zst')
+        self.file = open(path, 'wb')
+        self.stream = zstandard.ZstdCompressor(level=3, threads=-1).stream_writer(self.file)
+        self.tar = tarfile.open(fileobj=self.stream, mode='w|', format=tarfile.PAX_FORMAT)
+
+    def add_bytes(self, name, data, mode=FILE_MODE):
+        info = tarfile.TarInfo(name)
+        info.size = len(data)
+        info.mode = mode
+        info.mtime = int(time.time())
+        self.tar.addfile(info, io.BytesIO(data))
+
+    def add_file(self, name, path):
+        self.tar.add(path, name, recursive=False)
+
+    def close(self):
+        self.tar.close()
+        self.stream.close()
+        self.file.close()
+
+    def discard(self):
+        self.file.close()
+
+
+def get_archive_path(dest, app_name, archive_format):
+    return os.path.join(dest, app_name + ARCHIVE_FORMATS[archive_format])
+
+
+def get_installer_base_path(target_os):
+    return WIN_APPLICATIONS_PATH if target_os == 'windows' else MAC_APPLICATIONS_PATH
+
+
+def open_archive(path, archive_format):
+    if archive_format == 'zip':
+        return ZipArchiveWriter(path)
+    elif archive_format == 'tar.zst':
+        return TarZstArchiveWriter(path)
+    raise CcdlError('Unsupported archive format: ' + archive_format)
+
+
+def write_installer_archive(path, archive_format, app_name, target_os, prods, driver_xml):
+    """Stream installer layout from cache into a single archive without building the folder"""
+    print('Writing archive ' + path)
+    part_path = get_part_path(path)
+    archive = open_archive(part_path, archive_format)
+    try:
+        if target_os == 'windows':
+            archive.add_bytes(app_name + '/' + WIN_SCRIPT_NAME, WIN_INSTALLER_SCRIPT.encode('utf-8'))
+        else:
+            archive.add_bytes(app_name + '/' + MAC_SCRIPT_NAME, MAC_INSTALLER_SCRIPT.encode('utf-8'), SCRIPT_MODE)
+        archive.add_bytes(app_name + '/' + DRIVER_XML_NAME, driver_xml.encode('utf-8'))
+
+        for p in prods:
+            s = p['sapCode']
+            archive.add_bytes('{}/{}/application.json'.format(app_name, s),
+                              json.dumps(p['application_json'], separators=(',', ':')).encode('utf-8'))
+            for pkg in p['packages']:
+                name = get_url_file_name(pkg['Path'])
+                print('[{}_{}] Archive {}'.format(s, p['version'], name))
+                archive.add_file('{}/{}/{}'.format(app_name, s, name),
+                                 get_cache_product_file(get_file_path(pkg['Path'])))
+
+        archive.close()
+    except BaseException:
+        archive.discard()
+        if os.path.exists(part_path):
+            os.remove(part_path)
+        raise
+    commit_file(part_path, path)
+    sync_pending_files()
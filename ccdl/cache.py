@@ -0,0 +1,223 @@
+import json
+import os
+import shutil
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from ccdl.net import get_cache_dir, get_cache_lock, get_cache_packages_index, get_cache_product_file, \
+    get_file_path, get_url_file_name
+from ccdl.utils import check_archive, commit_file, file_lock, get_part_path, open_metadata, sync_pending_files
+
+PACKAGE_HASH_FIELDS = ('PackageHashKey', 'PackageHash', 'Hash', 'SHA256', 'MD5')
+
+package_index = None
+package_index_lock = threading.Lock()
+
+
+def get_package_size(pkg):
+    try:
+        return int(pkg.get('DownloadSize') or 0)
+    except (TypeError, ValueError):
+        return 0
+
+
+def get_package_key(pkg):
+    """Identity of package payload across app versions, None if metadata is insufficient"""
+    name = pkg.get('PackageName')
+    size = get_package_size(pkg)
+    if not name or not size:
+        return None
+    for field in PACKAGE_HASH_FIELDS:
+        if pkg.get(field):
+            return '{}|{}|{}:{}'.format(name, size, field, pkg[field])
+    if pkg.get('PackageVersion'):
+        return '{}|{}|version:{}'.format(name, size, pkg['PackageVersion'])
+    return None
+
+
+def build_package_index():
+    """Index packages of all cached application.json whose payload is already cached"""
+    index = {}
+    app_dir = os.path.join(get_cache_dir(), '_applications')
+    if not os.path.isdir(app_dir):
+        return index
+    for name in os.listdir(app_dir):
+        if not name.endswith(('.json', '.json.gz')) or name.endswith(('.index.json', '.index.json.gz')):
+            continue
+        try:
+            with open_metadata(os.path.join(app_dir, name)) as f:
+                app_json = json.load(f)
+            packages = app_json['Packages']['Package']
+        except (ValueError, KeyError, TypeError, OSError, EOFError):
+            continue
+        for pkg in packages:
+            key = get_package_key(pkg)
+            if key and key not in index and pkg.get('Path'):
+                path = get_cache_dir() + pkg['Path']
+                if os.path.isfile(path) and os.path.getsize(path) == get_package_size(pkg):
+                    index[key] = pkg['Path']
+    return index
+
+
+def load_package_index():
+    with package_index_lock:
+        return _load_package_index()
+
+
+def _load_package_index():
+    global package_index
+    if package_index is not None:
+        return package_index
+    package_index = {}
+    index_path = get_cache_packages_index()
+    if not index_path:
+        return package_index
+    if os.path.isfile(index_path):
+        with open(index_path, 'r') as f:
+            try:
+                package_index = json.load(f)
+            except ValueError as e:
+                print('Package index parse failed: ' + str(e))
+    if not package_index:
+        print('Building package index from cached application.json')
+        package_index = build_package_index()
+    return package_index
+
+
+def save_package_index():
+    """Merge into the index saved by other processes sharing the cache"""
+    index_path = get_cache_packages_index()
+    if not index_path or package_index is None:
+        return
+    with file_lock(get_cache_lock(index_path)):
+        index = {}
+        if os.path.isfile(index_path):
+            with open(index_path, 'r') as f:
+                try:
+                    index = json.load(f)
+                except ValueError:
+                    pass
+        with package_index_lock:
+            index.update(package_index)
+            package_index.update(index)
+        part_path = get_part_path(index_path)
+        with open(part_path, 'w') as f:
+            json.dump(index, f, separators=(',', ':'))
+        commit_file(part_path, index_path)
+    sync_pending_files()
+
+
+def register_package(pkg):
+    key = get_package_key(pkg)
+    if key and get_cache_dir():
+        load_package_index()[key] = pkg['Path']
+
+
+def link_file(src, dst):
+    """Hard link dst to src if the filesystem allows, else copy"""
+    try:
+        os.link(src, dst)
+    except OSError:
+        part_path = get_part_path(dst)
+        shutil.copyfile(src, part_path)
+        os.replace(part_path, dst)
+
+
+def reuse_package(pkg, s, v):
+    """Reuse an identical payload cached under another CDN path, return True if reused"""
+    key = get_package_key(pkg)
+    if not key or not get_cache_dir():
+        return False
+    cache_file_path = get_cache_product_file(pkg['Path'])
+    if os.path.isfile(cache_file_path):
+        return False
+    other = load_package_index().get(key)
+    if not other or other == pkg['Path']:
+        return False
+    other_path = get_cache_dir() + other
+    size = get_package_size(pkg)
+    if not os.path.isfile(other_path) or os.path.getsize(other_path) != size:
+        package_index.pop(key, None)
+        return False
+
+    with file_lock(get_cache_lock(cache_file_path)):
+        if os.path.isfile(cache_file_path):
+            return False
+        print('[{}_{}] Reuse identical package from {}'.format(s, v, other))
+        link_file(other_path, cache_file_path)
+    return True
+
+
+def print_reuse_summary(items):
+    """Report packages of one build reused from other versions"""
+    reused = [i for i in items if i.get('reused')]
+    if reused:
+        print('Reused {} packages from other versions, {:.1f} MiB saved'.format(
+            len(reused), sum(i['size'] for i in reused) / 0x100000))
+
+
+def find_installer_packages(root):
+    """Map CDN paths to package files of installer folders found under root, using their application.json"""
+    items = {}
+    for dir_path, _, file_names in os.walk(root):
+        if 'application.json' not in file_names:
+            continue
+        try:
+            with open(os.path.join(dir_path, 'application.json'), 'rb') as f:
+                packages = json.load(f)['Packages']['Package']
+        except (ValueError, KeyError, TypeError) as e:
+            print('Skip {}: {!r}'.format(dir_path, e))
+            continue
+        for pkg in packages:
+            if not pkg.get('Path'):
+                continue
+            path = get_file_path(pkg['Path'])
+            file_path = os.path.join(dir_path, get_url_file_name(path))
+            if path not in items and os.path.isfile(file_path):
+                items[path] = (file_path, pkg)
+    return items
+
+
+def import_package(path, file_path, pkg):
+    """Link a verified installer package into cache, return the import result"""
+    size = get_package_size(pkg)
+    if size and os.path.getsize(file_path) != size:
+        return 'mismatch'
+    cache_file_path = get_cache_product_file(path)
+    if os.path.isfile(cache_file_path) and os.path.getsize(cache_file_path) == os.path.getsize(file_path):
+        register_package(pkg)
+        return 'cached'
+    if check_archive(file_path) is False:
+        return 'corrupt'
+
+    with file_lock(get_cache_lock(cache_file_path)):
+        if os.path.isfile(cache_file_path):
+            os.remove(cache_file_path)
+        link_file(file_path, cache_file_path)
+    register_package(pkg)
+    return 'imported'
+
+
+def import_installers(root, jobs=1):
+    """Feed packages of previously built installer folders back into cache"""
+    items = find_installer_packages(root)
+    print('Found {} packages in {}'.format(len(items), root))
+
+    def run(item):
+        path, (file_path, pkg) = item
+        try:
+            result = import_package(path, file_path, pkg)
+        except OSError as e:
+            result = 'failed'
+            print('Import {} failed: {!r}'.format(file_path, e))
+        if result in ('mismatch', 'corrupt'):
+            print('Skip {} package {}'.format(result, file_path))
+        return result
+
+    counts = {}
+    with ThreadPoolExecutor(max(1, jobs)) as executor:
+        for result in executor.map(run, items.items()):
+            counts[result] = counts.get(result, 0) + 1
+    save_package_index()
+    print('Import finished: ' + ', '.join('{} {}'.format(n, r) for r, n in sorted(counts.items())))
+    return counts
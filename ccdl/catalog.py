@@ -0,0 +1,300 @@
+import gzip
+import json
+import os
+import re
+from sys import intern
+
+from ccdl.utils import commit_file, get_part_path, open_metadata
+
+CATALOG_FORMAT = 1
+
+
+def version_key(version):
+    """Sort key for dotted version strings, e.g. 9.1 < 10.0"""
+    return tuple(int(x) if x.isdigit() else -1 for x in re.split(r'[.\-_ ]', version))
+
+
+class ProductVersion:
+    """One platform build of a product version"""
+    __slots__ = ('sap_code', 'base_version', 'product_version', 'ap_platform', 'dependencies', 'build_guid',
+                 'locales')
+
+    def __init__(self, sap_code, base_version, product_version, ap_platform, dependencies, build_guid, locales):
+        self.sap_code = intern(sap_code)
+        self.base_version = intern(base_version) if base_version else base_version
+        self.product_version = product_version
+        self.ap_platform = intern(ap_platform)
+        self.dependencies = tuple((intern(d_sap), intern(d_version)) for d_sap, d_version in dependencies)
+        self.build_guid = build_guid
+        self.locales = tuple(intern(lc) for lc in locales if lc)
+
+
+class ProductView:
+    """Versions of a product resolved for a set of allowed platforms"""
+    __slots__ = ('versions', 'sorted_versions', 'latest')
+
+    def __init__(self, versions, sorted_versions, latest):
+        self.versions = versions
+        self.sorted_versions = sorted_versions
+        self.latest = latest
+
+
+class Product:
+    """All platform builds of a product, keyed by product version in catalog order"""
+    __slots__ = ('sap_code', 'display_name', 'hidden', 'builds', 'views')
+
+    def __init__(self, sap_code, display_name, hidden):
+        self.sap_code = intern(sap_code)
+        self.display_name = display_name
+        self.hidden = hidden
+        self.builds = {}
+        self.views = {}
+
+    def add_build(self, v):
+        self.builds[v.product_version] = self.builds.get(v.product_version, ()) + (v,)
+        self.views.clear()
+
+    def view(self, allowed_platforms):
+        """Resolve one build per version, cached per platform set
+
+        The first build on an allowed platform wins (macuniversal is listed before single arch builds),
+        otherwise the last build listed.
+        """
+        key = frozenset(allowed_platforms)
+        view = self.views.get(key)
+        if view is None:
+            versions = {}
+            for product_version, builds in self.builds.items():
+                versions[product_version] = next((b for b in builds if b.ap_platform in key), builds[-1])
+            sorted_versions = sorted((v.product_version for v in versions.values()
+                                      if v.build_guid and v.ap_platform in key), key=version_key)
+            latest = versions[sorted_versions[-1]] if sorted_versions else None
+            view = self.views[key] = ProductView(versions, sorted_versions, latest)
+        return view
+
+    def versions(self, allowed_platforms):
+        return self.view(allowed_platforms).versions
+
+    def sorted_versions(self, allowed_platforms):
+        """Downloadable versions on allowed platforms, oldest first"""
+        return self.view(allowed_platforms).sorted_versions
+
+    def latest(self, allowed_platforms):
+        """Latest downloadable version on allowed platforms, or None"""
+        return self.view(allowed_platforms).latest
+
+
+class CatalogIndex:
+    """Downloadable builds of a catalog with positions indexed by SAP code, platform and locale"""
+    __slots__ = ('builds', 'by_sap', 'by_platform', 'by_locale', 'visible')
+
+    def __init__(self, products):
+        self.builds = []
+        self.by_sap = {}
+        self.by_platform = {}
+        self.by_locale = {}
+        self.visible = set()
+        for p in products.values():
+            for builds in p.builds.values():
+                for b in builds:
+                    if not b.build_guid:
+                        continue
+                    i = len(self.builds)
+                    self.builds.append(b)
+                    self.by_sap.setdefault(b.sap_code, set()).add(i)
+                    self.by_platform.setdefault(b.ap_platform, set()).add(i)
+                    for lc in b.locales:
+                        self.by_locale.setdefault(lc, set()).add(i)
+                    if not p.hidden:
+                        self.visible.add(i)
+
+    @staticmethod
+    def union(index, keys):
+        return set().union(*(index.get(k, ()) for k in keys))
+
+    def query(self, products, sap_codes=None, name=None, platforms=None, locales=None, min_version=None,
+              max_version=None, latest=False, include_hidden=False):
+        """Return builds matching every given filter, locales must all be supported"""
+        positions = set(range(len(self.builds))) if include_hidden else set(self.visible)
+        if sap_codes:
+            positions &= self.union(self.by_sap, sap_codes)
+        if name:
+            name = name.lower()
+            positions &= self.union(self.by_sap, [s for s, p in products.items()
+                                                  if p.display_name and name in p.display_name.lower()])
+        if platforms:
+            positions &= self.union(self.by_platform, platforms)
+        for lc in locales or ():
+            positions &= self.by_locale.get(lc, set())
+
+        builds = [self.builds[i] for i in sorted(positions)]
+        if min_version:
+            builds = [b for b in builds if version_key(b.product_version) >= version_key(min_version)]
+        if max_version:
+            builds = [b for b in builds if version_key(b.product_version) <= version_key(max_version)]
+        if latest:
+            latest_builds = {}
+            for b in builds:
+                key = (b.sap_code, b.ap_platform)
+                if key not in latest_builds or \
+                        version_key(b.product_version) > version_key(latest_builds[key].product_version):
+                    latest_builds[key] = b
+            builds = list(latest_builds.values())
+        return sorted(builds, key=lambda b: (b.sap_code, version_key(b.product_version), b.ap_platform))
+
+
+class Catalog:
+    """Parsed products xml"""
+    __slots__ = ('url_version', 'cdn', 'products', 'sap_codes_cache', 'query_index')
+
+    def __init__(self, url_version, cdn, products):
+        self.url_version = url_version
+        self.cdn = cdn
+        self.products = products
+        self.sap_codes_cache = {}
+        self.query_index = None
+
+    def index(self):
+        if self.query_index is None:
+            self.query_index = CatalogIndex(self.products)
+        return self.query_index
+
+    def query(self, **filters):
+        return self.index().query(self.products, **filters)
+
+    def sap_codes(self, allowed_platforms):
+        """Visible products with a downloadable version: {sap_code: display_name}"""
+        key = frozenset(allowed_platforms)
+        sap_codes = self.sap_codes_cache.get(key)
+        if sap_codes is None:
+            sap_codes = self.sap_codes_cache[key] = {
+                p.sap_code: p.display_name for p in self.products.values()
+                if not p.hidden and p.latest(allowed_platforms)}
+        return sap_codes
+
+
+def snapshot_products(products, allowed_platforms):
+    """Downloadable versions per SAP code, used to diff catalogs between refreshes"""
+    snapshot = {}
+    for sap, p in products.items():
+        versions = p.sorted_versions(allowed_platforms)
+        if versions:
+            snapshot[sap] = list(versions)
+    return snapshot
+
+
+def load_snapshot(path):
+    if path and os.path.isfile(path):
+        try:
+            with open_metadata(path) as f:
+                return json.load(f)
+        except (ValueError, OSError, EOFError) as e:
+            print('Snapshot parse failed: ' + str(e))
+
+
+def save_snapshot(path, snapshot):
+    if path:
+        part_path = get_part_path(path)
+        with gzip.open(part_path, 'wt', encoding='utf-8') as f:
+            json.dump(snapshot, f, separators=(',', ':'), sort_keys=True)
+        commit_file(part_path, path)
+
+
+def catalog_to_dict(catalog):
+    """Plain form of a catalog, builds listed in catalog order"""
+    return {
+        'url_version': catalog.url_version,
+        'cdn': catalog.cdn,
+        'products': [[p.sap_code, p.display_name, p.hidden,
+                      [[b.base_version, b.product_version, b.ap_platform, b.dependencies, b.build_guid, b.locales]
+                       for builds in p.builds.values() for b in builds]]
+                     for p in catalog.products.values()],
+    }
+
+
+def catalog_from_dict(d):
+    products = {}
+    for sap, display_name, hidden, builds in d['products']:
+        p = products[sap] = Product(sap, display_name, hidden)
+        for base_version, product_version, ap_platform, dependencies, build_guid, locales in builds:
+            p.add_build(ProductVersion(sap, base_version, product_version, ap_platform, dependencies, build_guid,
+                                       locales))
+    return Catalog(d['url_version'], d['cdn'], products)
+
+
+def load_catalog(path, source_digest):
+    """Catalog saved by save_catalog, None if missing, corrupt or parsed from another products xml"""
+    if not path or not os.path.isfile(path):
+        return None
+    try:
+        with open_metadata(path) as f:
+            d = json.load(f)
+        if d.get('format') != CATALOG_FORMAT or d.get('source') != source_digest:
+            return None
+        return catalog_from_dict(d)
+    except (ValueError, KeyError, TypeError, OSError, EOFError) as e:
+        print('Catalog parse failed: ' + str(e))
+
+
+def save_catalog(path, catalog, source_digest):
+    """Save the parsed catalog compressed, bound to the digest of the products xml it was parsed from"""
+    if path:
+        d = dict(catalog_to_dict(catalog), format=CATALOG_FORMAT, source=source_digest)
+        part_path = get_part_path(path)
+        with gzip.open(part_path, 'wt', encoding='utf-8') as f:
+            json.dump(d, f, separators=(',', ':'))
+        commit_file(part_path, path)
+
+
+def diff_snapshots(old, new):
+    """Return {sap_code: {'added': [...], 'removed': [...]}} for SAP codes that changed"""
+    diff = {}
+    for sap in sorted(set(old) | set(new)):
+        old_versions = set(old.get(sap, ()))
+        new_versions = set(new.get(sap, ()))
+        added = sorted(new_versions - old_versions, key=version_key)
+        removed = sorted(old_versions - new_versions, key=version_key)
+        if added or removed:
+            diff[sap] = {'added': added, 'removed': removed}
+    return diff
+
+
+def print_diff(diff):
+    if not diff:
+        print('No catalog changes')
+        return
+    print('Catalog changes:')
+    for sap, d in diff.items():
+        for v in d['added']:
+            print('  + [{}]{}{}'.format(sap, (10 - len(sap)) * ' ', v))
+        for v in d['removed']:
+            print('  - [{}]{}{}'.format(sap, (10 - len(sap)) * ' ', v))
+
+
+QUERY_FIELDS = ('sapCode', 'displayName', 'productVersion', 'baseVersion', 'platform', 'buildGuid', 'locales',
+                'dependencies')
+
+
+def build_to_record(catalog, b):
+    return {
+        'sapCode': b.sap_code,
+        'displayName': catalog.products[b.sap_code].display_name,
+        'productVersion': b.product_version,
+        'baseVersion': b.base_version,
+        'platform': b.ap_platform,
+        'buildGuid': b.build_guid,
+        'locales': list(b.locales),
+        'dependencies': [{'sapCode': d_sap, 'version': d_version} for d_sap, d_version in b.dependencies],
+    }
+
+
+def format_query_result(catalog, builds, output_format='json'):
+    records = [build_to_record(catalog, b) for b in builds]
+    if output_format == 'json':
+        return json.dumps(records, indent=2)
+    lines = ['\t'.join(QUERY_FIELDS)]
+    for r in records:
+        r['locales'] = ','.join(r['locales'])
+        r['dependencies'] = ','.join('{}:{}'.format(d['sapCode'], d['version']) for d in r['dependencies'])
+        lines.append('\t'.join(str(r[f] or '') for f in QUERY_FIELDS))
+    return '\n'.join(lines)
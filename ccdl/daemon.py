@@ -0,0 +1,338 @@
+import argparse
+import builtins
+import contextvars
+import http.server
+import itertools
+import json
+import os
+import queue
+import socketserver
+import sys
+import threading
+import time
+
+from ccdl.apps import download_adobe_app
+from ccdl.archive import check_archive_format
+from ccdl.cache import load_package_index
+from ccdl.catalog import version_key
+from ccdl.net import set_pool_size, set_progress_bar
+from ccdl.packages import pipeline_observer
+from ccdl.prod import get_targets, get_targets_platforms, load_products, refresh_products
+from ccdl.server import JsonRequestHandler, parse_listen
+from ccdl.utils import CcdlError
+
+JOB_SPEC_FIELDS = ('sap_code', 'version', 'language', 'target', 'archive', 'os', 'arch')
+PROGRESS_INTERVAL = 2
+
+current_job = contextvars.ContextVar('current_job', default=None)
+
+
+class JobOutput:
+    """Stand-in for sys.stdout sending prints of job threads to the log of their job"""
+
+    def __init__(self, stream):
+        self.stream = stream
+
+    def write(self, text):
+        job = current_job.get()
+        if job is None:
+            return self.stream.write(text)
+        job.write(text)
+        return len(text)
+
+    def flush(self):
+        if current_job.get() is None:
+            self.stream.flush()
+
+    def __getattr__(self, name):
+        return getattr(self.stream, name)
+
+
+def no_input(prompt=''):
+    raise CcdlError('Interactive input not available in daemon: ' + prompt.strip())
+
+
+class Job:
+    """A queued build with its log, status and the progress of its package pipeline"""
+
+    def __init__(self, job_id, spec):
+        self.id = job_id
+        self.spec = spec
+        self.status = 'queued'
+        self.error = None
+        self.created = time.time()
+        self.started = None
+        self.finished = None
+        self.lines = []
+        self.partial = ''
+        self.pipeline = None
+        self.changed = threading.Condition()
+
+    def write(self, text):
+        with self.changed:
+            lines = (self.partial + text).split('\n')
+            self.partial = lines.pop()
+            if lines:
+                self.lines.extend(lines)
+                self.changed.notify_all()
+
+    def set_pipeline(self, pipeline):
+        self.pipeline = pipeline
+
+    def set_status(self, status, error=None):
+        with self.changed:
+            if self.partial:
+                self.lines.append(self.partial)
+                self.partial = ''
+            self.status = status
+            self.error = error
+            if status == 'running':
+                self.started = time.time()
+            elif status in ('done', 'failed'):
+                self.finished = time.time()
+            self.changed.notify_all()
+
+    def is_finished(self):
+        return self.status in ('done', 'failed')
+
+    def progress(self):
+        return self.pipeline.status() if self.pipeline else None
+
+    def to_dict(self):
+        return {
+            'id': self.id,
+            'spec': self.spec,
+            'status': self.status,
+            'error': self.error,
+            'created': self.created,
+            'started': self.started,
+            'finished': self.finished,
+            'log_lines': len(self.lines),
+            'progress': self.progress(),
+        }
+
+
+class BuildDaemon:
+    """Keep the parsed catalog and package index warm and run build jobs from a queue"""
+
+    def __init__(self, url_version, all_platforms, targets, args):
+        self.url_version = url_version
+        self.all_platforms = all_platforms
+        self.targets = targets
+        self.args = args
+        self.catalog = load_products(url_version, all_platforms, get_targets_platforms(targets))
+        self.catalog_lock = threading.Lock()
+        self.jobs = {}
+        self.jobs_lock = threading.Lock()
+        self.ids = itertools.count(1)
+        self.queue = queue.Queue()
+        load_package_index()
+
+    def start_workers(self):
+        for _ in range(max(1, self.args.jobs)):
+            threading.Thread(target=self.worker, daemon=True).start()
+
+    def submit(self, spec):
+        if not isinstance(spec, dict) or not spec.get('sap_code'):
+            raise CcdlError('Job requires sap_code')
+        unknown = [k for k in spec if k not in JOB_SPEC_FIELDS]
+        if unknown:
+            raise CcdlError('Unknown job fields: ' + ', '.join(unknown))
+        if spec.get('archive'):
+            check_archive_format(spec['archive'])
+        if spec.get('archive') and not (spec.get('target') or self.args.target):
+            raise CcdlError('Archive output requires target directory')
+        if spec.get('target'):
+            spec['target'] = self.get_target(spec['target'])
+        with self.jobs_lock:
+            job = Job(next(self.ids), spec)
+            self.jobs[job.id] = job
+        self.queue.put(job)
+        return job
+
+    def get_target(self, target):
+        """Resolve a job target, relative to --target, which jobs may not leave"""
+        if not self.args.target:
+            raise CcdlError('Job target requires the daemon to run with a target directory')
+        root = os.path.realpath(self.args.target)
+        path = os.path.realpath(os.path.join(root, target))
+        if os.path.commonpath([root, path]) != root:
+            raise CcdlError('Job target must be inside ' + root)
+        return path
+
+    def get_job(self, job_id):
+        with self.jobs_lock:
+            return self.jobs.get(job_id)
+
+    def list_jobs(self):
+        with self.jobs_lock:
+            return list(self.jobs.values())
+
+    def prune_jobs(self):
+        """Drop the oldest finished jobs and their logs beyond --keep_jobs"""
+        with self.jobs_lock:
+            finished = [job.id for job in self.jobs.values() if job.is_finished()]
+            for job_id in finished[:max(0, len(finished) - self.args.keep_jobs)]:
+                del self.jobs[job_id]
+
+    def refresh_catalog(self):
+        catalog, _, diff = refresh_products(self.url_version, self.all_platforms, get_targets_platforms(self.targets))
+        with self.catalog_lock:
+            self.catalog = catalog
+        return diff
+
+    def worker(self):
+        while True:
+            job = self.queue.get()
+            current_job.set(job)
+            pipeline_observer.set(job.set_pipeline)
+            job.set_status('running')
+            try:
+                self.build(job)
+                job.set_status('done')
+            except (Exception, SystemExit) as e:
+                job.set_status('failed', str(e) or repr(e))
+            finally:
+                current_job.set(None)
+                pipeline_observer.set(None)
+            self.prune_jobs()
+
+    def build(self, job):
+        spec = job.spec
+        _, targets = get_targets(spec.get('os') or self.args.os, spec.get('arch') or self.args.arch)
+        allowed_platforms = get_targets_platforms(targets)
+        missing = [p for p in allowed_platforms if p not in self.all_platforms]
+        if missing:
+            raise CcdlError('Platforms {} not in daemon catalog'.format(', '.join(missing)))
+
+        with self.catalog_lock:
+            catalog = self.catalog
+        sap_code = spec['sap_code'].upper()
+        sap_codes = catalog.sap_codes(allowed_platforms)
+        product = catalog.products.get(sap_code)
+        if product is None or sap_code not in sap_codes:
+            raise CcdlError('SAP code not found in products: ' + sap_code)
+
+        views = [product.view(platforms) for _, platforms in targets]
+        version = spec.get('version')
+        if version is None:
+            latest = [view.latest.product_version for view in views if view.latest]
+            if not latest:
+                raise CcdlError('No version of {} available for target'.format(sap_code))
+            version = max(latest, key=version_key)
+        elif not any(view.versions.get(version) for view in views):
+            raise CcdlError('Version {} of {} not available for target'.format(version, sap_code))
+
+        args = argparse.Namespace(sap_code=sap_code, app_version=version, language=spec.get('language') or 'ALL',
+                                  target=spec.get('target') or self.args.target, archive=spec.get('archive'),
+                                  gui=False, icon=None)
+        download_adobe_app(catalog.products, sap_codes, targets, args)
+
+
+class DaemonRequestHandler(JsonRequestHandler):
+    """JSON API: POST /jobs, GET /jobs, GET /jobs/<id>, GET /jobs/<id>/events, POST /catalog/refresh"""
+
+    daemon = None
+
+    def find_job(self, parts):
+        try:
+            job = self.daemon.get_job(int(parts[1]))
+        except ValueError:
+            job = None
+        if job is None:
+            self.send_json(404, {'error': 'Job not found'})
+        return job
+
+    def do_GET(self):
+        parts = self.path.strip('/').split('/')
+        if parts == ['jobs']:
+            self.send_json(200, [job.to_dict() for job in self.daemon.list_jobs()])
+        elif len(parts) == 2 and parts[0] == 'jobs':
+            job = self.find_job(parts)
+            if job:
+                self.send_json(200, dict(job.to_dict(), log=job.lines))
+        elif len(parts) == 3 and parts[0] == 'jobs' and parts[2] == 'events':
+            job = self.find_job(parts)
+            if job:
+                self.stream_events(job)
+        else:
+            self.send_json(404, {'error': 'Not found'})
+
+    def do_POST(self):
+        parts = self.path.strip('/').split('/')
+        try:
+            if parts == ['jobs']:
+                job = self.daemon.submit(self.read_json())
+                print('Job {} queued: {}'.format(job.id, job.spec))
+                self.send_json(202, job.to_dict())
+            elif parts == ['catalog', 'refresh']:
+                self.check_origin()
+                diff = self.daemon.refresh_catalog()
+                self.send_json(200, {'diff': diff})
+            else:
+                self.send_json(404, {'error': 'Not found'})
+        except CcdlError as e:
+            self.send_json(400, {'error': str(e)})
+
+    def send_event(self, event):
+        self.wfile.write(json.dumps(event, separators=(',', ':')).encode('utf-8') + b'\n')
+        self.wfile.flush()
+
+    def stream_events(self, job):
+        """Newline delimited JSON events of log lines and status until the job finished"""
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/x-ndjson')
+        self.end_headers()
+        sent = 0
+        status = None
+        last_progress = 0
+        try:
+            while True:
+                with job.changed:
+                    if sent == len(job.lines) and job.status == status and not job.is_finished():
+                        job.changed.wait(PROGRESS_INTERVAL)
+                    lines = job.lines[sent:]
+                    sent += len(lines)
+                    changed = job.status != status
+                    status = job.status
+                    finished = job.is_finished()
+                for line in lines:
+                    self.send_event({'type': 'log', 'line': line})
+                if changed or finished:
+                    self.send_event({'type': 'status', 'status': status, 'error': job.error})
+                if job.pipeline and time.time() - last_progress >= PROGRESS_INTERVAL:
+                    last_progress = time.time()
+                    self.send_event({'type': 'progress', 'stages': job.progress()})
+                if finished:
+                    break
+        except (BrokenPipeError, ConnectionResetError):
+            pass
+
+
+class UnixHTTPServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+
+def serve_daemon(url_version, all_platforms, targets, args):
+    """Serve the build job API until interrupted"""
+    set_progress_bar(False)
+    set_pool_size(max(10, args.jobs * args.download_jobs))
+    daemon = BuildDaemon(url_version, all_platforms, targets, args)
+    handler = type('Handler', (DaemonRequestHandler,), {'daemon': daemon})
+
+    if args.socket:
+        if os.path.exists(args.socket):
+            os.remove(args.socket)
+        server = UnixHTTPServer(args.socket, handler)
+        print('Daemon listening on unix socket ' + args.socket)
+    else:
+        server = http.server.ThreadingHTTPServer(parse_listen(args.listen), handler)
+        print('Daemon listening on http://{}:{}'.format(*server.server_address[:2]))
+
+    sys.stdout = JobOutput(sys.stdout)
+    builtins.input = no_input
+    daemon.start_workers()
+    try:
+        server.serve_forever()
+    finally:
+        server.server_close()
@@ -0,0 +1,275 @@
+import collections
+import http.server
+import os
+import socket
+import threading
+import time
+import uuid
+
+import requests
+
+from ccdl.net import fetch_url_as_file, get_cache_product_file, get_file_path, get_file_url
+from ccdl.packages import fill_item_sizes, get_item_cache_path, get_store_key, order_items
+from ccdl.server import JsonRequestHandler, parse_listen
+from ccdl.storage import evict_from_cache, get_store_size, put_to_store
+from ccdl.utils import CcdlError, sync_pending_files
+
+STATUS_INTERVAL = 10
+CLAIM_WAIT = 5
+WORKER_RETRY_COUNT = 5
+WORKER_RETRY_DELAY = 3
+
+coordinator_options = None
+
+
+def set_coordinator(listen, lease_time=300, attempts=3):
+    global coordinator_options
+    coordinator_options = (listen, lease_time, attempts)
+
+
+class PackageCoordinator:
+    """Hand out package downloads to workers under leases, a lease not renewed in time goes to another worker"""
+
+    def __init__(self, tasks, lease_time=300, attempts=3):
+        self.pending = collections.deque(tasks)
+        self.total = len(tasks)
+        self.lease_time = lease_time
+        self.attempts = attempts
+        self.leases = {}
+        self.failures = collections.Counter()
+        self.done = set()
+        self.failed = {}
+        self.lock = threading.Lock()
+        self.finished = threading.Event()
+        self.check_finished()
+
+    def check_finished(self):
+        if not self.pending and not self.leases:
+            self.finished.set()
+
+    def retry(self, task, error):
+        self.failures[task['key']] += 1
+        if self.failures[task['key']] >= self.attempts:
+            print('{} failed {} times, give up: {}'.format(task['key'], self.attempts, error))
+            self.failed[task['key']] = error
+        else:
+            print('{} failed, retry: {}'.format(task['key'], error))
+            self.pending.appendleft(task)
+
+    def expire(self):
+        now = time.time()
+        for lease_id, (task, worker, expires) in list(self.leases.items()):
+            if expires < now:
+                del self.leases[lease_id]
+                self.retry(task, 'lease of worker {} expired'.format(worker))
+        self.check_finished()
+
+    def claim(self, worker):
+        with self.lock:
+            self.expire()
+            if self.pending:
+                task = self.pending.popleft()
+                lease_id = uuid.uuid4().hex
+                self.leases[lease_id] = (task, worker, time.time() + self.lease_time)
+                return {'lease': lease_id, 'lease_time': self.lease_time, 'task': task}
+            if self.leases:
+                return {'wait': CLAIM_WAIT}
+            return {'done': True}
+
+    def renew(self, lease_id):
+        with self.lock:
+            lease = self.leases.get(lease_id)
+            if lease is None:
+                return False
+            self.leases[lease_id] = (lease[0], lease[1], time.time() + self.lease_time)
+            return True
+
+    def complete(self, lease_id, key, error=None):
+        with self.lock:
+            lease = self.leases.pop(lease_id, None)
+            if lease is None:
+                # Lease expired meanwhile, a late success still saves the retry
+                if not error and key not in self.done and key not in self.failed:
+                    self.done.add(key)
+                    self.pending = collections.deque(t for t in self.pending if t['key'] != key)
+            elif error:
+                self.retry(lease[0], error)
+            else:
+                self.done.add(key)
+            self.check_finished()
+
+    def status(self):
+        with self.lock:
+            return {'total': self.total, 'pending': len(self.pending), 'leased': len(self.leases),
+                    'done': len(self.done), 'failed': len(self.failed)}
+
+
+class CoordinatorRequestHandler(JsonRequestHandler):
+    """JSON API: POST /claim, POST /renew, POST /complete, GET /status"""
+
+    coordinator = None
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_GET(self):
+        if self.path == '/status':
+            self.send_json(200, self.coordinator.status())
+        else:
+            self.send_json(404, {'error': 'Not found'})
+
+    def do_POST(self):
+        try:
+            req = self.read_json()
+            if self.path == '/claim':
+                self.send_json(200, self.coordinator.claim(req.get('worker')))
+            elif self.path == '/renew':
+                self.send_json(200, {'renewed': self.coordinator.renew(req.get('lease'))})
+            elif self.path == '/complete':
+                self.coordinator.complete(req.get('lease'), req.get('key'), req.get('error'))
+                self.send_json(200, {})
+            else:
+                self.send_json(404, {'error': 'Not found'})
+        except CcdlError as e:
+            self.send_json(400, {'error': str(e)})
+
+
+def get_package_task(item):
+    url, path = get_file_url(item['pkg']['Path'])
+    return {'key': get_store_key(item), 'url': url, 'path': path, 'size': item['size'],
+            'sapCode': item['sapCode'], 'version': item['version']}
+
+
+def is_package_stored(item, journal=None):
+    """True if the package is already in local cache or store, no worker needs to fetch it"""
+    cache_file_path = get_item_cache_path(item)
+    if journal and journal.done('verified', cache_file_path):
+        return True
+    if os.path.isfile(cache_file_path) and os.path.getsize(cache_file_path) == item['size']:
+        return True
+    return bool(item['size']) and get_store_size(get_store_key(item)) == item['size']
+
+
+def distribute_packages(items, journal=None):
+    """Let workers fetch packages into the shared store or cache folder before they are used locally"""
+    if coordinator_options is None:
+        return
+    listen, lease_time, attempts = coordinator_options
+    fill_item_sizes(items, journal)
+    tasks = [get_package_task(item) for item in order_items(items) if not is_package_stored(item, journal)]
+    print('Distributing {} of {} packages to workers'.format(len(tasks), len(items)))
+    if not tasks:
+        return
+
+    coordinator = PackageCoordinator(tasks, lease_time, attempts)
+    handler = type('Handler', (CoordinatorRequestHandler,), {'coordinator': coordinator})
+    server = http.server.ThreadingHTTPServer(parse_listen(listen), handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    print('Coordinator listening on http://{}:{}, start workers with: ccdl.py -c <cache> worker '
+          '--coordinator http://<host>:{}'.format(*server.server_address[:2], server.server_address[1]))
+    try:
+        while not coordinator.finished.wait(STATUS_INTERVAL):
+            with coordinator.lock:
+                coordinator.expire()
+            print('Workers progress: {total} packages, {pending} pending, {leased} leased, {done} done, '
+                  '{failed} failed'.format(**coordinator.status()))
+        # Let workers polling for work see that all is done
+        time.sleep(CLAIM_WAIT + 1)
+    finally:
+        server.shutdown()
+        server.server_close()
+
+    if coordinator.failed:
+        raise CcdlError('Workers failed to fetch {} packages'.format(len(coordinator.failed)))
+    print('Workers fetched all packages')
+
+
+def fetch_package_task(task):
+    """Make the package available in store, or in the cache folder without store"""
+    prefix = '[{}_{}] '.format(task['sapCode'], task['version'])
+    if task['size'] and get_store_size(task['key']) == task['size']:
+        print(prefix + task['key'] + ' already in store')
+        return
+    cache_file_path = get_cache_product_file(get_file_path(task['path']))
+    print(prefix + 'Retrieve ' + task['key'])
+    fetch_url_as_file(task['url'], cache_file_path)
+    if put_to_store(cache_file_path, task['key']):
+        print(prefix + 'Uploaded {} to store'.format(task['key']))
+    evict_from_cache(cache_file_path, task['key'])
+    sync_pending_files()
+
+
+class PackageWorker:
+    """Claim package tasks from a coordinator until it has none left"""
+
+    def __init__(self, url, jobs=1, name=None):
+        self.url = url.rstrip('/')
+        self.jobs = max(1, jobs)
+        self.name = name or '{}-{}'.format(socket.gethostname(), os.getpid())
+        self.session = requests.Session()
+        self.active = {}
+        self.lock = threading.Lock()
+        self.stopped = threading.Event()
+        self.lease_time = None
+
+    def post(self, path, obj):
+        for _ in range(WORKER_RETRY_COUNT):
+            try:
+                response = self.session.post(self.url + path, json=obj, timeout=30)
+                response.raise_for_status()
+                return response.json()
+            except (requests.RequestException, ValueError):
+                time.sleep(WORKER_RETRY_DELAY)
+        return None
+
+    def renew_leases(self):
+        while not self.stopped.wait(self.lease_time / 3 if self.lease_time else CLAIM_WAIT):
+            with self.lock:
+                leases = list(self.active)
+            for lease_id in leases:
+                result = self.post('/renew', {'lease': lease_id})
+                if result is not None and not result.get('renewed'):
+                    print('Lease {} lost, the package may be fetched twice'.format(lease_id))
+
+    def work(self):
+        while True:
+            claim = self.post('/claim', {'worker': self.name})
+            if claim is None:
+                print('Coordinator not reachable, exit')
+                return
+            if claim.get('done'):
+                return
+            if 'wait' in claim:
+                time.sleep(claim['wait'])
+                continue
+
+            lease_id, task = claim['lease'], claim['task']
+            self.lease_time = claim['lease_time']
+            with self.lock:
+                self.active[lease_id] = task
+            error = None
+            try:
+                fetch_package_task(task)
+            except (Exception, SystemExit) as e:
+                error = str(e) or repr(e)
+                print('Fetch {} failed: {}'.format(task['key'], error))
+            finally:
+                with self.lock:
+                    del self.active[lease_id]
+            self.post('/complete', {'lease': lease_id, 'key': task['key'], 'error': error})
+
+    def run(self):
+        print('Worker {} fetching for {}'.format(self.name, self.url))
+        renewer = threading.Thread(target=self.renew_leases, daemon=True)
+        renewer.start()
+        threads = [threading.Thread(target=self.work) for _ in range(self.jobs)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        self.stopped.set()
+        print('Worker {} finished'.format(self.name))
+
+
+def run_worker(url, jobs=1, name=None):
+    PackageWorker(url, jobs, name).run()
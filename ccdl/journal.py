@@ -0,0 +1,94 @@
+import json
+import os
+import threading
+
+from ccdl.net import get_cache_journal
+
+JOURNAL_OPS = ('verified', 'materialized', 'installer')
+
+
+def get_file_state(path):
+    try:
+        st = os.stat(path)
+    except OSError:
+        return None
+    return [st.st_size, st.st_mtime_ns]
+
+
+class BuildJournal:
+    """Append-only record of files a build completed, replayed by a rerun of the same build to skip them
+
+    A record holds the size and mtime of the file, a file changed since it was recorded is done again.
+    """
+
+    def __init__(self, path, key):
+        self.path = path
+        self.key = key
+        self.lock = threading.Lock()
+        self.records = {op: {} for op in JOURNAL_OPS}
+        if self.load():
+            self.file = open(path, 'a')
+        else:
+            self.file = open(path, 'w')
+            self.file.write(json.dumps({'key': key}) + '\n')
+            self.file.flush()
+
+    def load(self):
+        if not os.path.isfile(self.path):
+            return False
+        with open(self.path, 'r') as f:
+            lines = f.read().split('\n')
+        try:
+            header = json.loads(lines[0])
+        except ValueError:
+            return False
+        if header.get('key') != self.key:
+            return False
+        for line in lines[1:]:
+            try:
+                r = json.loads(line)
+            except ValueError:
+                # Last line torn by an interruption
+                continue
+            if r.get('op') in self.records:
+                self.records[r['op']][r['path']] = r['state']
+        return True
+
+    def done(self, op, path):
+        """True if op recorded path and the file is unchanged since"""
+        state = self.records[op].get(path)
+        return state is not None and state == get_file_state(path)
+
+    def get_size(self, op, path):
+        """Size of the file recorded by op, 0 if it is not done"""
+        return self.records[op][path][0] if self.done(op, path) else 0
+
+    def record(self, op, path):
+        state = get_file_state(path)
+        with self.lock:
+            self.records[op][path] = state
+            self.file.write(json.dumps({'op': op, 'path': path, 'state': state}) + '\n')
+            self.file.flush()
+
+    def count(self, op):
+        return len(self.records[op])
+
+    def close(self):
+        with self.lock:
+            if not self.file.closed:
+                self.file.flush()
+                os.fsync(self.file.fileno())
+                self.file.close()
+
+
+def open_build_journal(key):
+    """Journal of the build identified by the json serializable key, None without a cache folder"""
+    key = json.dumps(key, sort_keys=True, separators=(',', ':'))
+    path = get_cache_journal(key)
+    if not path:
+        return None
+    journal = BuildJournal(path, key)
+    if journal.count('verified') or journal.count('installer'):
+        print('Resume build from journal: {} packages verified, {} files materialized, {} installers finished'.format(
+            journal.count('verified'), journal.count('materialized'), journal.count('installer')))
+    return journal
@@ -3,7 +3,7 @@ import shutil
 import stat
 from subprocess import PIPE, Popen
 
-from ccdl.utils import DRIVER_XML_NAME
+from ccdl.utils import DRIVER_XML_NAME, CcdlError
 
 ADOBE_HDBOX_SETUP = '/Library/Application Support/Adobe/Adobe Desktop Common/HDBox/Setup'
 ADOBE_CC_MAC_ICON_PATH = '/Library/Application Support/Adobe/Adobe Desktop Common/HDBox/Install.app/Contents/' + \
@@ -175,7 +175,7 @@ echo Done
 '''.format(hdbox_setup=ADOBE_HDBOX_SETUP, driver_xml_name=DRIVER_XML_NAME)
 
 
-def get_platforms(target_arch=None):
+def get_platforms(target_arch=None, strict=True):
     if not target_arch:
         return ['macuniversal', 'macarm64', 'osx10-64', 'osx10']
     elif target_arch == 'universal':
@@ -186,9 +186,10 @@ def get_platforms(target_arch=None):
         return ['macuniversal', 'macarm64']
     elif target_arch == 'x86_64' or target_arch == 'x64':
         return ['macuniversal', 'osx10-64', 'osx10']
+    elif not strict:
+        return None
     else:
-        print('Invalid argument "{}" for {}'.format(target_arch, 'architecture'))
-        exit(1)
+        raise CcdlError('Invalid argument "{}" for {}'.format(target_arch, 'architecture'))
 
 
 def create_mac_installer(app_name, dest, use_gui=False, icon_path=None):
@@ -1,16 +1,20 @@
+import gzip
+import hashlib
 import json
 import os
 import random
-import shutil
 import string
 import time
+from email.utils import formatdate
 from xml.etree import ElementTree as ET
 
 import requests
+from requests.adapters import HTTPAdapter
 from requests.exceptions import ReadTimeout, ConnectionError
 from tqdm.auto import tqdm
 
-from ccdl.utils import check_archive
+from ccdl.utils import CcdlError, check_archive, commit_file, compress_file, copy_file, file_lock, get_lock_path, \
+    get_part_path, open_metadata, preallocate, remove_legacy_locks, remove_stale_parts
 
 ADOBE_PRODUCTS_XML_URL = 'https://prod-rel-ffc-ccm.oobesaas.adobe.com/adobe-ffc-external/core/v{url_version}/products/' \
                          'all?_type=xml&channel=ccm&channel=sti&platform={installPlatform}&productType=Desktop'
@@ -29,40 +33,110 @@ ADOBE_DL_HEADERS = {
 
 cdn = None
 cache_dir = None
+catalog_ttl = None
 session = requests.sessions.Session()
 session_timeout = 15
 session_retry_count = 10
 session_retry_delay = 3
+progress_bar_enabled = True
 
 
 def set_cache_dir(path):
     global cache_dir
     cache_dir = path
+    remove_legacy_locks(os.path.join(path, '_locks'))
+
+
+def get_cache_dir():
+    return cache_dir
+
+
+def set_catalog_ttl(seconds):
+    global catalog_ttl
+    catalog_ttl = seconds
 
 
 def set_header_auth(auth):
     ADOBE_REQ_HEADERS['Authorization'] = auth
 
 
+def set_progress_bar(enabled):
+    global progress_bar_enabled
+    progress_bar_enabled = enabled
+
+
+def set_pool_size(size):
+    """Keep enough pooled connections for concurrent downloads"""
+    adapter = HTTPAdapter(pool_connections=size, pool_maxsize=size)
+    session.mount('https://', adapter)
+    session.mount('http://', adapter)
+
+
 def set_cdn(url):
     global cdn
     cdn = url
 
 
-def get_cache_products_xml(url_version, allowed_platforms):
+def get_cache_products_xml(url_version):
+    """Products xml of all platforms, one per url version"""
+    if cache_dir:
+        path = os.path.join(cache_dir, '_products', str(url_version), 'products.xml.gz')
+        os.makedirs(path[:path.rfind('/')], exist_ok=True)
+        return path
+
+
+def get_cache_products_catalog(url_version, allowed_platforms):
+    """Catalog parsed from products xml for a platform set"""
     if cache_dir:
-        path = os.path.join(cache_dir, '_products', str(url_version), '_'.join(allowed_platforms) + '.xml')
+        path = os.path.join(cache_dir, '_products', str(url_version), '_'.join(allowed_platforms) + '.catalog.json.gz')
+        os.makedirs(path[:path.rfind('/')], exist_ok=True)
+        return path
+
+
+def get_cache_products_snapshot(url_version, allowed_platforms, kind='snapshot'):
+    """Catalog snapshot of a platform set, watch mode keeps its own kind so builds do not consume its changes"""
+    if cache_dir:
+        path = os.path.join(cache_dir, '_products', str(url_version),
+                            '{}.{}.json.gz'.format('_'.join(allowed_platforms), kind))
         os.makedirs(path[:path.rfind('/')], exist_ok=True)
         return path
 
 
 def get_cache_product_json(build_guid):
     if cache_dir:
-        path = os.path.join(cache_dir, '_applications', build_guid + '.json')
+        path = os.path.join(cache_dir, '_applications', build_guid + '.json.gz')
+        os.makedirs(path[:path.rfind('/')], exist_ok=True)
+        return path
+
+
+def get_cache_product_selection(build_guid):
+    if cache_dir:
+        path = os.path.join(cache_dir, '_applications', build_guid + '.index.json.gz')
         os.makedirs(path[:path.rfind('/')], exist_ok=True)
         return path
 
 
+def get_cache_packages_index():
+    if cache_dir:
+        path = os.path.join(cache_dir, '_packages', 'index.json')
+        os.makedirs(path[:path.rfind('/')], exist_ok=True)
+        return path
+
+
+def get_cache_journal(key):
+    if cache_dir:
+        path = os.path.join(cache_dir, '_journals', hashlib.sha1(key.encode('utf-8')).hexdigest() + '.jsonl')
+        os.makedirs(path[:path.rfind('/')], exist_ok=True)
+        return path
+
+
+def get_cache_lock(path):
+    """Lock file guarding writes of a cached file"""
+    lock_dir = os.path.join(cache_dir or os.path.dirname(path), '_locks')
+    os.makedirs(lock_dir, exist_ok=True)
+    return get_lock_path(lock_dir, path)
+
+
 def get_cache_product_file(path):
     if cache_dir:
         path = cache_dir + path
@@ -98,8 +172,7 @@ def fetch_url_as_text(url, headers=ADOBE_REQ_HEADERS):
             return response.text
         except (ConnectionError, ReadTimeout):
             time.sleep(session_retry_delay)
-    print('Connection error, give up')
-    exit(1)
+    raise CcdlError('Connection error, give up')
 
 
 def fetch_url_head(url, headers):
@@ -108,8 +181,7 @@ def fetch_url_head(url, headers):
             return session.head(url, stream=True, headers=headers, timeout=session_timeout)
         except (ConnectionError, ReadTimeout):
             time.sleep(session_retry_delay)
-    print('Connection error, give up')
-    exit(1)
+    raise CcdlError('Connection error, give up')
 
 
 def fetch_url_get_progress(url, path, headers):
@@ -121,48 +193,154 @@ def fetch_url_get_progress(url, path, headers):
             total_size_in_bytes = int(response.headers.get('content-length', 0))
             block_size = get_block_size(total_size_in_bytes)
             if total_size_in_bytes != 0:
-                progress_bar = tqdm(total=total_size_in_bytes, unit='iB', unit_scale=True)
+                progress_bar = tqdm(total=total_size_in_bytes, unit='iB', unit_scale=True,
+                                    disable=not progress_bar_enabled)
+                received = 0
                 with open(path, 'wb') as file:
-                    for data in response.iter_content(block_size):
-                        file.write(data)
-                        progress_bar.update(len(data))
+                    preallocate(file, total_size_in_bytes)
+                    try:
+                        for data in response.iter_content(block_size):
+                            file.write(data)
+                            received += len(data)
+                            progress_bar.update(len(data))
+                    finally:
+                        if received < total_size_in_bytes:
+                            file.truncate(received)
                 progress_bar.close()
-                if progress_bar.n < total_size_in_bytes:
-                    print("Error, expect {} bytes, received {} bytes.".format(total_size_in_bytes, progress_bar.n))
-                    exit(1)
+                if received < total_size_in_bytes:
+                    raise CcdlError("Error, expect {} bytes, received {} bytes.".format(total_size_in_bytes, received))
             else:
                 with open(path, 'wb') as file:
                     for data in response.iter_content(block_size):
                         file.write(data)
-                        print('.', end='', flush=True)
-                    print('')
+                        if progress_bar_enabled:
+                            print('.', end='', flush=True)
+                    if progress_bar_enabled:
+                        print('')
             return
 
         except (ConnectionError, ReadTimeout):
             if progress_bar:
                 progress_bar.close()
             time.sleep(session_retry_delay)
-    print('Connection error, give up')
-    exit(1)
+    raise CcdlError('Connection error, give up')
 
 
-def fetch_url_as_file(url, path, headers=ADOBE_REQ_HEADERS):
-    """Retrieve from a url and save to file"""
+def fetch_url_if_modified(url, path, headers=ADOBE_REQ_HEADERS):
+    """Re-fetch a cached file only if the server copy changed, return True if it was replaced"""
+    headers = headers.copy()
+    headers['If-Modified-Since'] = formatdate(os.path.getmtime(path), usegmt=True)
+    etag_path = path + '.etag'
+    if os.path.isfile(etag_path):
+        with open(etag_path, 'r') as f:
+            headers['If-None-Match'] = f.read().strip()
+
+    print('Refresh: ' + url)
+    for _ in range(0, session_retry_count):
+        try:
+            response = session.get(url, headers=headers, timeout=session_timeout)
+            if response.status_code == 304:
+                os.utime(path)
+                return False
+            if response.status_code != 200:
+                print('Refresh failed with HTTP {}, keep cached file'.format(response.status_code))
+                return False
+            with file_lock(get_cache_lock(path)):
+                part_path = get_part_path(path)
+                with open(part_path, 'wb') as file:
+                    file.write(gzip.compress(response.content) if path.endswith('.gz') else response.content)
+                commit_file(part_path, path)
+                if response.headers.get('ETag'):
+                    with open(etag_path, 'w') as f:
+                        f.write(response.headers['ETag'])
+            return True
+        except (ConnectionError, ReadTimeout):
+            time.sleep(session_retry_delay)
+    raise CcdlError('Connection error, give up')
+
+
+def is_cache_expired(path, ttl):
+    return ttl is not None and time.time() - os.path.getmtime(path) >= ttl
+
+
+def fetch_url_as_part(url, path, headers=ADOBE_REQ_HEADERS):
+    """Retrieve from a url into a part file aside path, return the part path, None if path is up to date
+
+    The part file is unique to the thread, so no lock is held while it is written. It takes the cache path in
+    commit_verified_file, so an interrupted run never leaves an unchecked file at the cache path.
+    """
+    remove_stale_parts(path)
     response = fetch_url_head(url, headers)
     total_size_in_bytes = int(response.headers.get('content-length', 0))
 
     if os.path.isfile(path):
         if total_size_in_bytes == 0 or os.path.getsize(path) == total_size_in_bytes:
-            return
-        print('remove outdated file: ' + path)
-        os.remove(path)
+            return None
+        print('replace outdated file: ' + path)
 
-    fetch_url_get_progress(url, path, headers)
+    part_path = get_part_path(path)
+    try:
+        fetch_url_get_progress(url, part_path, headers)
+    except BaseException:
+        if os.path.exists(part_path):
+            os.remove(part_path)
+        raise
+    return part_path
+
+
+def commit_verified_file(part_path, path):
+    """Check a completely written part file and rename it to path, a corrupt one is removed
+
+    The lock is only held to commit, a file of the same size committed meanwhile by another process is kept.
+    """
+    if check_archive(part_path, path) is False:
+        os.remove(part_path)
+        raise CcdlError('Remove corrupt file and exit: ' + path)
+    with file_lock(get_cache_lock(path)):
+        if os.path.isfile(path) and os.path.getsize(path) == os.path.getsize(part_path):
+            os.remove(part_path)
+        else:
+            commit_file(part_path, path)
 
-    if check_archive(path) is False:
-        print('Remove corrupt file and exit: ' + path)
-        os.remove(path)
-        exit(1)
+
+def fetch_url_as_file(url, path, headers=ADOBE_REQ_HEADERS):
+    """Retrieve from a url, check and save to file, return True if the file was downloaded"""
+    part_path = fetch_url_as_part(url, path, headers)
+    if part_path is None:
+        return False
+    commit_verified_file(part_path, path)
+    return True
+
+
+def fetch_url_as_compressed_file(url, path, headers=ADOBE_REQ_HEADERS):
+    """Retrieve from a url and save gzip compressed, under a lock shared with other ccdl processes"""
+    with file_lock(get_cache_lock(path)):
+        raw_path = get_part_path(path) + '.raw'
+        try:
+            fetch_url_get_progress(url, raw_path, headers)
+            compress_file(raw_path, path)
+        finally:
+            if os.path.exists(raw_path):
+                os.remove(raw_path)
+
+
+def migrate_metadata(path):
+    """Compress a metadata file cached uncompressed by an older version"""
+    old_path = path[:-3]
+    if not os.path.exists(path) and os.path.isfile(old_path):
+        with file_lock(get_cache_lock(path)):
+            if os.path.isfile(old_path):
+                compress_file(old_path, path)
+                os.remove(old_path)
+
+
+def remove_legacy_products_xml(url_version):
+    """Remove products xml cached per platform set by older versions, with their ETag"""
+    dir_path = os.path.join(cache_dir, '_products', str(url_version))
+    for name in os.listdir(dir_path):
+        if name.endswith(('.xml', '.xml.etag')):
+            print('Remove legacy products xml: ' + name)
+            os.remove(os.path.join(dir_path, name))
 
 
 def parse_xml(text, path=None, corrupt_exit=False):
@@ -173,47 +351,70 @@ def parse_xml(text, path=None, corrupt_exit=False):
         if path and os.path.exists(path):
             os.remove(path)
     if corrupt_exit:
-        print('Corrupt products xml received, exit')
-        exit(1)
+        raise CcdlError('Corrupt products xml received, exit')
 
 
-def fetch_products_xml(url_version, allowed_platforms):
-    cache_xml = get_cache_products_xml(url_version, allowed_platforms)
-    if cache_xml and os.path.exists(cache_xml):
+def parse_xml_file(path, corrupt_exit=False):
+    """Parse a cached xml while it is decompressed, remove it if corrupt"""
+    try:
+        with open_metadata(path, 'rb') as f:
+            return ET.parse(f).getroot()
+    except (ET.ParseError, OSError, EOFError) as e:
+        print('XML parse failed: ' + str(e))
+        os.remove(path)
+    if corrupt_exit:
+        raise CcdlError('Corrupt xml received, exit')
+
+
+def refresh_products_xml(url_version, all_platforms, refresh=False):
+    """Re-fetch the cached products xml if asked or expired, return its path if it is cached"""
+    cache_xml = get_cache_products_xml(url_version)
+    if not cache_xml or not os.path.exists(cache_xml):
+        return None
+    if refresh or is_cache_expired(cache_xml, catalog_ttl):
+        products_url = get_adobe_products_url(url_version, all_platforms)
+        if fetch_url_if_modified(products_url, cache_xml):
+            print('Products xml updated')
+        else:
+            print('Products xml not modified')
+    return cache_xml
+
+
+def fetch_products_xml(url_version, all_platforms, refresh=False):
+    """Products xml listing all_platforms, cached compressed once per url version"""
+    cache_xml = refresh_products_xml(url_version, all_platforms, refresh)
+    if cache_xml:
         print('Read products xml from ' + cache_xml)
-        with open(cache_xml, 'r') as f:
-            products_xml_text = f.read()
-        products_xml = parse_xml(products_xml_text, cache_xml)
-        if products_xml:
+        products_xml = parse_xml_file(cache_xml)
+        if products_xml is not None:
             return products_xml
 
-    products_url = get_adobe_products_url(url_version, allowed_platforms)
+    products_url = get_adobe_products_url(url_version, all_platforms)
     print('Downloading products xml')
+    cache_xml = get_cache_products_xml(url_version)
     if cache_xml:
-        fetch_url_as_file(products_url, cache_xml)
-        with open(cache_xml, 'r') as f:
-            products_xml_text = f.read()
-        return parse_xml(products_xml_text, cache_xml, corrupt_exit=True)
+        fetch_url_as_compressed_file(products_url, cache_xml)
+        remove_legacy_products_xml(url_version)
+        return parse_xml_file(cache_xml, corrupt_exit=True)
 
     return parse_xml(fetch_url_as_text(products_url), corrupt_exit=True)
 
 
 def fetch_app_xml(path):
     cache_xml = get_cache_product_file(path)
+    if cache_xml:
+        cache_xml += '.gz'
+        migrate_metadata(cache_xml)
     if cache_xml and os.path.exists(cache_xml):
         print('Read application xml from ' + cache_xml)
-        with open(cache_xml, 'r') as f:
-            app_xml_text = f.read()
-        app_xml = parse_xml(app_xml_text, cache_xml)
-        if app_xml:
+        app_xml = parse_xml_file(cache_xml)
+        if app_xml is not None:
             return app_xml
 
     print('Downloading application xml')
     if cache_xml:
-        fetch_url_as_file(cdn + path, cache_xml)
-        with open(cache_xml, 'r') as f:
-            app_xml_text = f.read()
-        return parse_xml(app_xml_text, cache_xml, corrupt_exit=True)
+        fetch_url_as_compressed_file(cdn + path, cache_xml)
+        return parse_xml_file(cache_xml, corrupt_exit=True)
 
     return parse_xml(fetch_url_as_text(cdn + path), corrupt_exit=True)
 
@@ -226,8 +427,19 @@ def parse_json(text, path=None, corrupt_exit=False):
         if path and os.path.exists(path):
             os.remove(path)
     if corrupt_exit:
-        print('Corrupt JSON received, exit')
-        exit(1)
+        raise CcdlError('Corrupt JSON received, exit')
+
+
+def parse_json_file(path, corrupt_exit=False):
+    """Parse a cached JSON while it is decompressed, remove it if corrupt"""
+    try:
+        with open_metadata(path) as f:
+            return json.load(f)
+    except (ValueError, OSError, EOFError) as e:
+        print('JSON parse failed:' + str(e))
+        os.remove(path)
+    if corrupt_exit:
+        raise CcdlError('Corrupt JSON received, exit')
 
 
 def fetch_application_json(build_guid):
@@ -235,40 +447,69 @@ def fetch_application_json(build_guid):
     headers = ADOBE_REQ_HEADERS.copy()
     headers['x-adobe-build-guid'] = build_guid
     file_path = get_cache_product_json(build_guid)
+    if file_path:
+        migrate_metadata(file_path)
     if file_path and os.path.exists(file_path):
-        with open(file_path, 'rb') as f:
-            json_text = f.read()
-        json_obj = parse_json(json_text, file_path)
+        json_obj = parse_json_file(file_path)
         if json_obj:
             return json_obj
 
     if file_path:
-        fetch_url_as_file(ADOBE_APPLICATION_JSON_URL, file_path, headers)
-        with open(file_path, 'rb') as f:
-            json_text = f.read()
-        return parse_json(json_text, file_path, corrupt_exit=True)
+        fetch_url_as_compressed_file(ADOBE_APPLICATION_JSON_URL, file_path, headers)
+        return parse_json_file(file_path, corrupt_exit=True)
 
     return parse_json(fetch_url_as_text(ADOBE_APPLICATION_JSON_URL, headers), corrupt_exit=True)
 
 
-def fetch_file(path, app_dir, sap_code, version, name=None):
-    """Download a file"""
+def get_url_file_name(path):
+    return path.split('/')[-1].split('?')[0]
+
+
+def get_file_path(path):
+    """Return cache path of a CDN path or full url"""
     if path[:4] != 'http':
-        url = cdn + path
-    else:
-        url = path
-        path = path[path.find('/', path.find('//') + 3):]
+        return path
+    return path[path.find('/', path.find('//') + 3):]
+
+
+def get_file_url(path):
+    """Return url and cache path of a CDN path or full url"""
+    if path[:4] != 'http':
+        return cdn + path, path
+    return path, get_file_path(path)
+
+
+def download_file(path, sap_code, version, name=None, verify=True):
+    """Download a file into cache, return cache path and whether it was downloaded
 
+    Without verify the part file left to commit_verified_file is returned instead, None if already cached.
+    """
+    url, path = get_file_url(path)
     if not name:
-        name = path.split('/')[-1].split('?')[0]
+        name = get_url_file_name(path)
     print('[{}_{}] Retrieve {}'.format(sap_code, version, name))
 
     cache_file_path = get_cache_product_file(path)
-    fetch_url_as_file(url, cache_file_path)
+    if not verify:
+        return cache_file_path, fetch_url_as_part(url, cache_file_path)
+    return cache_file_path, fetch_url_as_file(url, cache_file_path)
+
+
+def materialize_file(cache_file_path, app_dir, sap_code, version, name):
+    """Copy a cached file into app folder, return the destination path"""
+    file_path = os.path.join(app_dir, name)
+    if os.path.isfile(file_path) and os.path.getsize(file_path) == os.path.getsize(cache_file_path):
+        print('[{}_{}] {} already exists, skipping'.format(sap_code, version, name))
+    else:
+        copy_file(cache_file_path, file_path)
+    return file_path
+
+
+def fetch_file(path, app_dir, sap_code, version, name=None):
+    """Download a file"""
+    if not name:
+        name = get_url_file_name(get_file_url(path)[1])
+    cache_file_path, _ = download_file(path, sap_code, version, name)
 
     if app_dir:
-        file_path = os.path.join(app_dir, name)
-        if os.path.isfile(file_path) and os.path.getsize(file_path) == os.path.getsize(cache_file_path):
-            print('[{}_{}] {} already exists, skipping'.format(sap_code, version, name))
-        else:
-            shutil.copyfile(cache_file_path, file_path)
+        materialize_file(cache_file_path, app_dir, sap_code, version, name)
@@ -0,0 +1,233 @@
+import contextvars
+import heapq
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+
+from ccdl.cache import get_package_size, link_file, print_reuse_summary, register_package, reuse_package
+from ccdl.net import ADOBE_REQ_HEADERS, commit_verified_file, download_file, fetch_url_head, get_cache_dir, \
+    get_cache_product_file, get_file_path, get_file_url, get_url_file_name, materialize_file, set_pool_size
+from ccdl.pipeline import Pipeline, Stage
+from ccdl.storage import evict_from_cache, fetch_from_store, put_to_store
+from ccdl.utils import CcdlError, check_disk_space, sync_pending_files
+
+download_jobs = 1
+verify_jobs = 1
+materialize_jobs = 1
+queue_size = 4
+ignore_space = False
+# Called with the package pipeline once it is created, lets the daemon report progress of its jobs
+pipeline_observer = contextvars.ContextVar('pipeline_observer', default=None)
+running_pipelines = set()
+# Reentrant, the SIGINT handler may run while the main thread holds it
+running_pipelines_lock = threading.RLock()
+
+SMALL_PACKAGE_SIZE = 0x100000
+
+
+def set_pipeline_jobs(download=1, verify=1, materialize=1, size=4):
+    global download_jobs, verify_jobs, materialize_jobs, queue_size
+    download_jobs, verify_jobs, materialize_jobs, queue_size = download, verify, materialize, size
+    set_pool_size(max(10, download))
+
+
+def set_ignore_space(ignore):
+    global ignore_space
+    ignore_space = ignore
+
+
+def request_stop():
+    """Stop feeding running pipelines so they end after packages in flight, False if none was running"""
+    with running_pipelines_lock:
+        pipelines = [p for p in running_pipelines if not p.stopping.is_set()]
+        for p in pipelines:
+            p.stop()
+    return bool(pipelines)
+
+
+def get_item_cache_path(item):
+    return get_cache_product_file(get_file_path(item['pkg']['Path']))
+
+
+def get_store_key(item):
+    return get_file_path(item['pkg']['Path']).lstrip('/')
+
+
+def download_package(item, journal=None):
+    pkg, s, v = item['pkg'], item['sapCode'], item['version']
+    cache_file_path = get_item_cache_path(item)
+    if journal and journal.done('verified', cache_file_path):
+        item['cache_path'], item['journaled'] = cache_file_path, True
+        return item
+    item['reused'] = reuse_package(pkg, s, v)
+    part_path = None if os.path.isfile(cache_file_path) else \
+        fetch_from_store(get_store_key(item), cache_file_path, item['size'])
+    if part_path:
+        print('[{}_{}] Fetched {} from store'.format(s, v, get_url_file_name(pkg['Path'])))
+        item['cache_path'], item['part_path'], item['stored'] = cache_file_path, part_path, True
+        return item
+    # The part file takes the cache path once the verify stage checked it
+    item['cache_path'], item['part_path'] = download_file(pkg['Path'], s, v, verify=False)
+    return item
+
+
+def verify_package(item, journal=None):
+    if item.get('part_path'):
+        commit_verified_file(item['part_path'], item['cache_path'])
+        item['part_path'] = None
+    register_package(item['pkg'])
+    if not item.get('stored') and not item.get('journaled') and put_to_store(item['cache_path'], get_store_key(item)):
+        print('[{}_{}] Uploaded {} to store'.format(
+            item['sapCode'], item['version'], get_url_file_name(item['pkg']['Path'])))
+    if journal and not item.get('journaled'):
+        journal.record('verified', item['cache_path'])
+    return item if item['product_dirs'] else None
+
+
+def materialize_package(item, journal=None):
+    """Copy package into the first installer, later installers share the first copy"""
+    s, v, product_dirs = item['sapCode'], item['version'], item['product_dirs']
+    name = get_url_file_name(item['pkg']['Path'])
+    dsts = [os.path.join(d, name) for d in product_dirs]
+    if journal and all(journal.done('materialized', dst) for dst in dsts):
+        return
+    src = materialize_file(item['cache_path'], product_dirs[0], s, v, name)
+    for d in product_dirs[1:]:
+        dst = os.path.join(d, name)
+        if os.path.isfile(dst):
+            if os.path.getsize(dst) == os.path.getsize(src):
+                continue
+            os.remove(dst)
+        link_file(src, dst)
+    if len(product_dirs) > 1:
+        print('[{}_{}] {} shared with {} more installers'.format(s, v, name, len(product_dirs) - 1))
+    if journal:
+        for dst in dsts:
+            journal.record('materialized', dst)
+
+
+def get_remote_size(item):
+    response = fetch_url_head(get_file_url(item['pkg']['Path'])[0], ADOBE_REQ_HEADERS)
+    return int(response.headers.get('content-length', 0))
+
+
+def fill_item_sizes(items, journal=None):
+    """Package size from application.json or journal, HEAD content-length if it is missing"""
+    missing = []
+    for item in items:
+        item['size'] = get_package_size(item['pkg'])
+        if not item['size'] and journal:
+            item['size'] = journal.get_size('verified', get_item_cache_path(item))
+        if not item['size']:
+            missing.append(item)
+    if missing:
+        print('Query size of {} packages'.format(len(missing)))
+        with ThreadPoolExecutor(max_workers=max(1, download_jobs)) as executor:
+            for item, size in zip(missing, executor.map(get_remote_size, missing)):
+                item['size'] = size
+
+
+def order_items(items):
+    """Largest packages first so none of them starts last, small ones interleaved between them"""
+    ordered = sorted(items, key=lambda i: i['size'], reverse=True)
+    large = [i for i in ordered if i['size'] >= SMALL_PACKAGE_SIZE]
+    small = [i for i in ordered if i['size'] < SMALL_PACKAGE_SIZE]
+    if not large or not small:
+        return ordered
+    step = -(-len(small) // len(large))
+    result = []
+    for n, item in enumerate(large):
+        result.append(item)
+        result.extend(small[n * step:(n + 1) * step])
+    return result
+
+
+def estimate_makespan(items, jobs):
+    """Bytes on the busiest connection when items are started in order on the first free connection"""
+    loads = [0] * max(1, jobs)
+    for item in items:
+        heapq.heapreplace(loads, loads[0] + item['size'])
+    return max(loads)
+
+
+def check_packages_space(items, archive_dir=None, archive_bytes=0):
+    """Refuse to start if cache and installer volumes cannot hold the outstanding packages"""
+    cache_bytes = 0
+    target_bytes = {}
+    for item in items:
+        cache_file_path = get_item_cache_path(item)
+        if not os.path.isfile(cache_file_path) or os.path.getsize(cache_file_path) != item['size']:
+            cache_bytes += item['size']
+        if item['product_dirs']:
+            d = item['product_dirs'][0]
+            if not os.path.isfile(os.path.join(d, get_url_file_name(item['pkg']['Path']))):
+                target_bytes[d] = target_bytes.get(d, 0) + item['size']
+
+    requirements = {get_cache_dir(): cache_bytes}
+    for d, size in target_bytes.items():
+        requirements[d] = requirements.get(d, 0) + size
+    if archive_dir:
+        requirements[archive_dir] = requirements.get(archive_dir, 0) + archive_bytes
+    check_disk_space(requirements, ignore_space)
+
+
+def remove_unverified_parts(items):
+    """Remove downloads a stopped or failed pipeline left before the verify stage"""
+    for item in items:
+        if item.get('part_path') and os.path.exists(item['part_path']):
+            os.remove(item['part_path'])
+
+
+def create_package_pipeline(journal=None):
+    return Pipeline([
+        Stage('download', partial(download_package, journal=journal), download_jobs, queue_size),
+        Stage('verify', partial(verify_package, journal=journal), verify_jobs, queue_size),
+        Stage('materialize', partial(materialize_package, journal=journal), materialize_jobs, queue_size),
+    ])
+
+
+def fetch_packages(items, archive_dir=None, archive_bytes=0, journal=None):
+    """Run package items {sapCode, version, pkg, product_dirs} through download, verify and materialize stages
+
+    Work recorded in the journal is skipped, and completed work is recorded into it.
+    """
+    fill_item_sizes(items, journal)
+    check_packages_space(items, archive_dir, archive_bytes)
+    items = order_items(items)
+    total = sum(i['size'] for i in items)
+    print('Scheduled {} packages, {:.1f} MiB, busiest of {} connections gets {:.1f} MiB'.format(
+        len(items), total / 0x100000, download_jobs, estimate_makespan(items, download_jobs) / 0x100000))
+
+    pipeline = create_package_pipeline(journal)
+    observer = pipeline_observer.get()
+    if observer:
+        observer(pipeline)
+    with running_pipelines_lock:
+        running_pipelines.add(pipeline)
+    try:
+        errors = pipeline.run(items)
+    finally:
+        with running_pipelines_lock:
+            running_pipelines.discard(pipeline)
+        remove_unverified_parts(items)
+    sync_pending_files()
+    pipeline.print_report()
+    download = pipeline.stages[0]
+    print('Download makespan {:.1f}s'.format(download.last_done - pipeline.start_time if download.last_done else 0))
+    print_reuse_summary(items)
+    if errors:
+        for stage, item, e in errors:
+            print('[{}_{}] {} failed at {}: {!r}'.format(
+                item['sapCode'], item['version'], get_url_file_name(item['pkg']['Path']), stage, e))
+        raise CcdlError('{} of {} packages failed'.format(len(errors), len(items)))
+    if pipeline.stopping.is_set():
+        raise CcdlError('Build stopped, run it again to resume')
+
+
+def evict_packages(items):
+    """Remove packages of a finished build from the cache folder if the store holds them and eviction is on"""
+    evicted = [i for i in items if evict_from_cache(get_item_cache_path(i), get_store_key(i))]
+    if evicted:
+        print('Evicted {} packages held by the store from cache, {:.1f} MiB freed'.format(
+            len(evicted), sum(i['size'] for i in evicted) / 0x100000))
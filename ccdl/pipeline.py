@@ -0,0 +1,144 @@
+import contextvars
+import queue
+import threading
+import time
+
+_END = object()
+
+
+class Stage:
+    """Workers of one pipeline stage reading from a bounded input queue"""
+
+    def __init__(self, name, func, jobs=1, queue_size=4):
+        self.name = name
+        self.func = func
+        self.jobs = max(1, jobs)
+        self.queue = queue.Queue(max(1, queue_size))
+        self.lock = threading.Lock()
+        self.busy_time = 0.0
+        self.done = 0
+        self.failed = 0
+        self.active = 0
+        self.max_depth = 0
+        self.depth_sum = 0
+        self.depth_samples = 0
+        self.finished = 0
+        self.last_done = None
+
+    def put(self, item):
+        self.queue.put(item)
+        depth = self.queue.qsize()
+        with self.lock:
+            self.max_depth = max(self.max_depth, depth)
+            self.depth_sum += depth
+            self.depth_samples += 1
+
+    def status(self, elapsed):
+        with self.lock:
+            return {
+                'stage': self.name,
+                'jobs': self.jobs,
+                'active': self.active,
+                'done': self.done,
+                'failed': self.failed,
+                'queue_depth': self.queue.qsize(),
+                'queue_max_depth': self.max_depth,
+                'queue_avg_depth': self.depth_sum / self.depth_samples if self.depth_samples else 0.0,
+                'utilization': self.busy_time / (self.jobs * elapsed) if elapsed > 0 else 0.0,
+            }
+
+
+class Pipeline:
+    """Run items through stages connected by bounded queues, each stage with its own concurrency
+
+    A stage function returns the item handed to the next stage, or None to drop it. A full queue blocks
+    the stage feeding it, so a slow stage throttles the ones before it.
+    """
+
+    def __init__(self, stages):
+        self.stages = stages
+        self.errors = []
+        self.errors_lock = threading.Lock()
+        self.start_time = None
+        self.end_time = None
+        self.stopping = threading.Event()
+
+    def elapsed(self):
+        if self.start_time is None:
+            return 0.0
+        return (self.end_time or time.time()) - self.start_time
+
+    def status(self):
+        elapsed = self.elapsed()
+        return [s.status(elapsed) for s in self.stages]
+
+    def stop(self):
+        """Stop feeding new items, items already in the pipeline are completed"""
+        self.stopping.set()
+
+    def _worker(self, i):
+        stage = self.stages[i]
+        next_stage = self.stages[i + 1] if i + 1 < len(self.stages) else None
+        while True:
+            item = stage.queue.get()
+            if item is _END:
+                with stage.lock:
+                    stage.finished += 1
+                    last = stage.finished == stage.jobs
+                if last and next_stage:
+                    for _ in range(next_stage.jobs):
+                        next_stage.put(_END)
+                return
+
+            with stage.lock:
+                stage.active += 1
+            start = time.time()
+            try:
+                result = stage.func(item)
+                failed = False
+            except BaseException as e:
+                result = None
+                failed = True
+                with self.errors_lock:
+                    self.errors.append((stage.name, item, e))
+            with stage.lock:
+                stage.active -= 1
+                stage.last_done = time.time()
+                stage.busy_time += stage.last_done - start
+                if failed:
+                    stage.failed += 1
+                else:
+                    stage.done += 1
+            if result is not None and next_stage:
+                next_stage.put(result)
+
+    def run(self, items):
+        """Feed items and wait until every stage drained, return the list of (stage, item, error)"""
+        self.start_time = time.time()
+        threads = []
+        for i, stage in enumerate(self.stages):
+            for _ in range(stage.jobs):
+                # Workers see the context variables of the caller, eg. the daemon job their output belongs to
+                t = threading.Thread(target=contextvars.copy_context().run, args=(self._worker, i), daemon=True)
+                t.start()
+                threads.append(t)
+
+        first = self.stages[0]
+        for item in items:
+            if self.stopping.is_set():
+                break
+            first.put(item)
+        for _ in range(first.jobs):
+            first.put(_END)
+
+        for t in threads:
+            t.join()
+        self.end_time = time.time()
+        return self.errors
+
+    def print_report(self):
+        print('Pipeline finished in {:.1f}s'.format(self.elapsed()))
+        for s in self.status():
+            print('  {:<12} jobs={} done={} failed={} queue max/avg={}/{:.1f} utilization={:.0%}'.format(
+                s['stage'], s['jobs'], s['done'], s['failed'], s['queue_max_depth'], s['queue_avg_depth'],
+                s['utilization']))
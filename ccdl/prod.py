@@ -1,10 +1,12 @@
 import os
 import platform
-from collections import OrderedDict
 
+from ccdl.catalog import Catalog, Product, ProductVersion, diff_snapshots, load_catalog, load_snapshot, print_diff, \
+    save_catalog, save_snapshot, snapshot_products
 from ccdl.mac import get_platforms as get_mac_platforms
-from ccdl.net import set_cdn, fetch_products_xml
-from ccdl.utils import DRIVER_XML_NAME
+from ccdl.net import set_cdn, fetch_products_xml, get_cache_products_catalog, get_cache_products_snapshot, \
+    get_cache_products_xml, migrate_metadata, refresh_products_xml
+from ccdl.utils import DRIVER_XML_NAME, CcdlError, get_file_digest, split_list
 from ccdl.win import get_platforms as get_win_platforms
 
 DRIVER_XML = '''<DriverInfo>
@@ -32,59 +34,51 @@ DRIVER_XML_DEPENDENCY = '''
             </Dependency>'''
 
 
-def parse_products_xml(products_xml, url_version, allowed_platforms):
-    """Parsing the XML."""
+def parse_products_xml(products_xml, url_version, platforms=None):
+    """Parsing the XML, builds of platforms not listed are skipped."""
     prefix = 'channels/' if url_version == 6 else ''
     cdn = products_xml.find(prefix + 'channel/cdn/secure').text
 
+    apro_versions = {}
+    if url_version == 6:
+        for b in products_xml.findall('builds/build'):
+            if b.get('id') == 'APRO':
+                apro_versions.setdefault(b.get('version'), b.find('nglLicensingInfo/appVersion').text)
+
     products = {}
     parent_map = {c: p for p in products_xml.iter() for c in p}
     for p in products_xml.findall(prefix + 'channel/products/product'):
         sap = p.get('id')
         hidden = parent_map[parent_map[p]].get('name') != 'ccm'
         display_name = p.find('displayName').text
-        product_version = p.get('version')
         if not products.get(sap):
-            products[sap] = {
-                'hidden': hidden,
-                'displayName': display_name,
-                'sapCode': sap,
-                'versions': OrderedDict()
-            }
+            products[sap] = Product(sap, display_name, hidden)
 
         for pf in p.findall('platforms/platform'):
+            if platforms is not None and pf.get('id') not in platforms:
+                continue
+            product_version = p.get('version')
             base_version = pf.find('languageSet').get('baseVersion')
             build_guid = pf.find('languageSet').get('buildGuid')
             app_platform = pf.get('id')
-            dependencies = list(pf.findall('languageSet/dependencies/dependency'))
-            if product_version in products[sap]['versions']:
-                if products[sap]['versions'][product_version]['apPlatform'] in allowed_platforms:
-                    break  # There's no single-arch binary if macuniversal is available
+            dependencies = pf.findall('languageSet/dependencies/dependency')
 
             if sap == 'APRO':
                 base_version = product_version
                 if url_version == 4 or url_version == 5:
                     product_version = pf.find('languageSet/nglLicensingInfo/appVersion').text
                 if url_version == 6:
-                    for b in products_xml.findall('builds/build'):
-                        if b.get("id") == sap and b.get("version") == base_version:
-                            product_version = b.find('nglLicensingInfo/appVersion').text
-                            break
+                    product_version = apro_versions.get(base_version, product_version)
                 build_guid = pf.find('languageSet/urls/manifestURL').text
                 # This is actually manifest URL
 
-            products[sap]['versions'][product_version] = {
-                'sapCode': sap,
-                'baseVersion': base_version,
-                'productVersion': product_version,
-                'apPlatform': app_platform,
-                'dependencies': [{'sapCode': d.find('sapCode').text, 'version': d.find('baseVersion').text}
-                                 for d in dependencies],
-                'buildGuid': build_guid,
-                'locale': [lc.attrib.get('name') for lc in pf.findall('languageSet/locales/locale')],
-            }
+            products[sap].add_build(ProductVersion(
+                sap, base_version, product_version, app_platform,
+                [(d.find('sapCode').text, d.find('baseVersion').text) for d in dependencies],
+                build_guid,
+                [lc.attrib.get('name') for lc in pf.findall('languageSet/locales/locale')]))
 
-    return products, cdn
+    return Catalog(url_version, cdn, products)
 
 
 def get_url_version(url_version):
@@ -114,56 +108,144 @@ def get_url_version(url_version):
     return url_version
 
 
-def get_platforms(target_os=None, target_arch=None):
+def get_platforms(target_os=None, target_arch=None, strict=True):
     target_os = (platform.system() if target_os is None else target_os).lower()
     target_arch = (platform.machine() if target_arch is None else target_arch).lower()
 
     if target_os == 'darwin':
-        return get_mac_platforms(), get_mac_platforms(target_arch)
+        allowed_platforms = get_mac_platforms(target_arch, strict)
+        return (get_mac_platforms(), allowed_platforms) if allowed_platforms else None
     elif target_os == 'windows':
-        return get_win_platforms(), get_win_platforms(target_arch)
+        allowed_platforms = get_win_platforms(target_arch, strict)
+        return (get_win_platforms(), allowed_platforms) if allowed_platforms else None
+    elif not strict:
+        return None
+    else:
+        raise CcdlError('Unsupported OS platform: ' + target_os)
+
+
+def get_known_platforms():
+    """Platforms of every supported OS"""
+    return get_mac_platforms() + get_win_platforms()
+
+
+def get_targets(target_os=None, target_arch=None):
+    """Resolve comma separated OS and arch lists to all catalog platforms and [(os, allowed_platforms)]
+
+    With several OS or arch values, combinations that do not exist (eg. windows arm64) are skipped.
+    """
+    os_list = split_list(target_os) or [platform.system()]
+    arch_list = split_list(target_arch) or [platform.machine()]
+    strict = len(os_list) == 1 and len(arch_list) == 1
+    all_platforms = []
+    targets = []
+    for t_os in os_list:
+        for t_arch in arch_list:
+            platforms = get_platforms(t_os, t_arch, strict)
+            if platforms is None:
+                print('Skip unsupported target {} {}'.format(t_os, t_arch))
+                continue
+            all_platforms.extend(p for p in platforms[0] if p not in all_platforms)
+            target = (t_os.lower(), platforms[1])
+            if target not in targets:
+                targets.append(target)
+    if not targets:
+        raise CcdlError('No supported target in OS {} and architecture {}'.format(target_os, target_arch))
+    return all_platforms, targets
+
+
+def get_targets_platforms(targets):
+    """Platforms allowed by any of the targets"""
+    allowed_platforms = []
+    for _, platforms in targets:
+        allowed_platforms.extend(p for p in platforms if p not in allowed_platforms)
+    return allowed_platforms
+
+
+def load_products(url_version, all_platforms, allowed_platforms, refresh=False):
+    """Catalog of all_platforms from the products xml shared by all platforms, parsed once per xml change"""
+    known_platforms = get_known_platforms()
+    catalog_path = get_cache_products_catalog(url_version, all_platforms)
+    cache_xml = refresh_products_xml(url_version, known_platforms, refresh)
+    catalog = load_catalog(catalog_path, get_file_digest(cache_xml)) if cache_xml else None
+    if catalog:
+        print('Read parsed catalog from ' + catalog_path)
+    else:
+        products_xml = fetch_products_xml(url_version, known_platforms)
+        print('Parsing products xml ... ')
+        catalog = parse_products_xml(products_xml, url_version, all_platforms)
+        cache_xml = get_cache_products_xml(url_version)
+        if cache_xml and os.path.isfile(cache_xml):
+            save_catalog(catalog_path, catalog, get_file_digest(cache_xml))
+    set_cdn(catalog.cdn)
+
+    sap_codes = catalog.sap_codes(allowed_platforms)
+    print('total ' + str(len(sap_codes)) + ' products found. CDN: ' + catalog.cdn)
+
+    return catalog
+
+
+def update_snapshot(products, url_version, allowed_platforms, previous=None, kind='snapshot'):
+    """Diff the parsed catalog against the previous snapshot, return the new snapshot and the diff"""
+    snapshot_path = get_cache_products_snapshot(url_version, allowed_platforms, kind)
+    if previous is None:
+        if snapshot_path:
+            migrate_metadata(snapshot_path)
+        previous = load_snapshot(snapshot_path)
+    snapshot = snapshot_products(products, allowed_platforms)
+    save_snapshot(snapshot_path, snapshot)
+    return snapshot, (None if previous is None else diff_snapshots(previous, snapshot))
+
+
+def forget_snapshot_versions(snapshot, versions, url_version, allowed_platforms, kind='snapshot'):
+    """Drop [(sap_code, version)] from the snapshot, the next refresh reports them as added again"""
+    for sap_code, version in versions:
+        if version in snapshot.get(sap_code, ()):
+            snapshot[sap_code].remove(version)
+    save_snapshot(get_cache_products_snapshot(url_version, allowed_platforms, kind), snapshot)
+
+
+def refresh_products(url_version, all_platforms, allowed_platforms, previous=None, kind='snapshot'):
+    """Re-fetch the products xml if modified and report added/removed versions"""
+    catalog = load_products(url_version, all_platforms, allowed_platforms, refresh=True)
+    snapshot, diff = update_snapshot(catalog.products, url_version, allowed_platforms, previous, kind)
+    if diff is None:
+        print('Catalog snapshot created')
     else:
-        print('Unsupported OS platform: ' + target_os)
-        exit(1)
+        print_diff(diff)
+    return catalog, snapshot, diff
 
 
 def get_products(all_platforms, allowed_platforms, args):
     url_version = get_url_version(args.url_version)
-    products_xml = fetch_products_xml(url_version, all_platforms)
-
-    print('Parsing products xml ... ')
-    products, cdn = parse_products_xml(products_xml, url_version, allowed_platforms)
-    set_cdn(cdn)
-
-    sap_codes = {}
-    for p in products.values():
-        if not p['hidden']:
-            versions = p['versions']
-            last_v = None
-            for v in reversed(versions.values()):
-                if v['buildGuid'] and v['apPlatform'] in allowed_platforms:
-                    last_v = v['productVersion']
-            if last_v:
-                sap_codes[p['sapCode']] = p['displayName']
-    print('total ' + str(len(sap_codes)) + ' products found. CDN: ' + cdn)
+    catalog = load_products(url_version, all_platforms, allowed_platforms)
+    products = catalog.products
+
+    _, diff = update_snapshot(products, url_version, allowed_platforms)
+    if diff:
+        print_diff(diff)
 
     if args.sap_code and products.get(args.sap_code.upper()) is None:
         print('Provided SAP Code not found in products: ' + args.sapCode)
         args.sapCode = None
 
-    return products, sap_codes
+    return products, catalog.sap_codes(allowed_platforms)
 
 
-def save_driver_xml(app_base_path, app_dir, product, prod_info, ap_platform, install_language):
-    print('Generating driver.xml')
-    driver = DRIVER_XML.format(
-        name=product['displayName'],
-        sapCode=prod_info['sapCode'],
-        version=prod_info['productVersion'],
+def get_driver_xml(app_base_path, product, prod_info, ap_platform, install_language):
+    return DRIVER_XML.format(
+        name=product.display_name,
+        sapCode=prod_info.sap_code,
+        version=prod_info.product_version,
         installPlatform=ap_platform,
-        dependencies=''.join([DRIVER_XML_DEPENDENCY.format(sapCode=d['sapCode'], version=d['version'])
-                              for d in prod_info['dependencies']]),
+        dependencies=''.join([DRIVER_XML_DEPENDENCY.format(sapCode=d_sap, version=d_version)
+                              for d_sap, d_version in prod_info.dependencies]),
         base_path=app_base_path,
         language=install_language)
+
+
+def save_driver_xml(app_base_path, app_dir, product, prod_info, ap_platform, install_language):
+    print('Generating driver.xml')
+    driver = get_driver_xml(app_base_path, product, prod_info, ap_platform, install_language)
     with open(os.path.join(app_dir, DRIVER_XML_NAME), 'w') as f:
         f.write(driver)
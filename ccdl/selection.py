@@ -0,0 +1,65 @@
+import gzip
+import json
+import os
+import re
+
+from ccdl.net import get_cache_product_selection, migrate_metadata
+from ccdl.utils import commit_file, get_part_path, open_metadata
+
+SELECTION_INDEX_VERSION = 1
+LANGUAGE_CONDITION_RE = re.compile(r'\[installLanguage\]\s*==\s*([A-Za-z_]+)')
+
+
+def build_selection_index(app_json):
+    """Map package conditions of application.json to package positions
+
+    core: core packages, always selected
+    any: packages without language condition, always selected
+    languages: {language: packages whose condition requires it}
+    """
+    core = []
+    any_lang = []
+    languages = {}
+    packages = app_json['Packages']['Package']
+    for i, pkg in enumerate(packages):
+        if pkg.get('Type') == 'core':
+            core.append(i)
+            continue
+        langs = set(LANGUAGE_CONDITION_RE.findall(pkg.get('Condition') or ''))
+        if not langs:
+            any_lang.append(i)
+        for lang in sorted(langs):
+            languages.setdefault(lang, []).append(i)
+    return {'version': SELECTION_INDEX_VERSION, 'count': len(packages), 'core': core, 'any': any_lang,
+            'languages': languages}
+
+
+def load_selection_index(build_guid, app_json):
+    """Read the selection index cached beside application.json, build and save it if missing or stale"""
+    path = get_cache_product_selection(build_guid)
+    count = len(app_json['Packages']['Package'])
+    if path:
+        migrate_metadata(path)
+    if path and os.path.isfile(path):
+        try:
+            with open_metadata(path) as f:
+                index = json.load(f)
+            if index.get('version') == SELECTION_INDEX_VERSION and index.get('count') == count:
+                return index
+        except (ValueError, OSError, EOFError) as e:
+            print('Selection index parse failed: ' + str(e))
+
+    index = build_selection_index(app_json)
+    if path:
+        part_path = get_part_path(path)
+        with gzip.open(part_path, 'wt', encoding='utf-8') as f:
+            json.dump(index, f, separators=(',', ':'))
+        commit_file(part_path, path)
+    return index
+
+
+def select_positions(index, app_lang):
+    """Positions of packages selected for one install language, ALL selects every package"""
+    if app_lang == 'ALL':
+        return set(range(index['count']))
+    return set(index['core']) | set(index['any']) | set(index['languages'].get(app_lang, ()))
@@ -0,0 +1,43 @@
+import http.server
+import json
+
+from ccdl.utils import CcdlError
+
+
+class JsonRequestHandler(http.server.BaseHTTPRequestHandler):
+    """Request handler exchanging JSON bodies"""
+
+    def log_message(self, format, *args):
+        print(format % args)
+
+    def send_json(self, code, obj):
+        body = json.dumps(obj, separators=(',', ':')).encode('utf-8')
+        self.send_response(code)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def check_origin(self):
+        """Refuse requests sent by web pages, a browser adds Origin to cross-site requests"""
+        if self.headers.get('Origin'):
+            raise CcdlError('Cross-origin requests not allowed')
+
+    def read_json(self):
+        """Body of a request sent as application/json, which a web page cannot send without CORS approval"""
+        self.check_origin()
+        if self.headers.get_content_type() != 'application/json':
+            raise CcdlError('Content-Type must be application/json')
+        length = int(self.headers.get('Content-Length') or 0)
+        try:
+            return json.loads(self.rfile.read(length) or b'{}')
+        except ValueError as e:
+            raise CcdlError('Invalid JSON: ' + str(e))
+
+
+def parse_listen(listen):
+    host, _, port = listen.rpartition(':')
+    try:
+        return host or '127.0.0.1', int(port)
+    except ValueError:
+        raise CcdlError('Invalid listen address: ' + listen)
@@ -0,0 +1,172 @@
+import os
+import shutil
+
+from ccdl.net import get_cache_lock
+from ccdl.utils import CcdlError, commit_file, copy_file, file_lock, get_lock_path, get_part_path, \
+    remove_stale_parts
+
+try:
+    import boto3
+    from boto3.s3.transfer import TransferConfig
+    from botocore.config import Config
+    from botocore.exceptions import BotoCoreError, ClientError
+except ImportError:
+    boto3 = None
+
+MULTIPART_SIZE = 0x4000000
+
+store = None
+evict_cached = False
+
+
+class LocalStorage:
+    """Shared store in a folder, eg. a network mount used by several build agents"""
+
+    name = 'folder'
+
+    def __init__(self, root):
+        self.root = root
+
+    def get_path(self, key):
+        return os.path.join(self.root, key)
+
+    def get_size(self, key):
+        path = self.get_path(key)
+        return os.path.getsize(path) if os.path.isfile(path) else None
+
+    def download(self, key, path):
+        copy_file(self.get_path(key), path)
+
+    def upload(self, path, key):
+        dst = self.get_path(key)
+        os.makedirs(os.path.dirname(dst), exist_ok=True)
+        lock_dir = os.path.join(self.root, '_locks')
+        os.makedirs(lock_dir, exist_ok=True)
+        with file_lock(get_lock_path(lock_dir, key)):
+            part_path = get_part_path(dst)
+            copy_file(path, part_path)
+            commit_file(part_path, dst)
+
+
+class S3Storage:
+    """Shared store in an S3 compatible bucket, large objects are transferred in parallel parts"""
+
+    name = 's3'
+
+    def __init__(self, bucket, prefix='', endpoint_url=None, jobs=4):
+        if boto3 is None:
+            raise CcdlError('Python module boto3 is required for s3 store')
+        self.bucket = bucket
+        self.prefix = prefix
+        self.client = boto3.client('s3', endpoint_url=endpoint_url,
+                                   config=Config(max_pool_connections=max(10, jobs * 2)))
+        self.transfer = TransferConfig(multipart_threshold=MULTIPART_SIZE, multipart_chunksize=MULTIPART_SIZE,
+                                       max_concurrency=max(1, jobs), use_threads=True)
+
+    def get_key(self, key):
+        return self.prefix + key
+
+    def get_size(self, key):
+        try:
+            return self.client.head_object(Bucket=self.bucket, Key=self.get_key(key))['ContentLength']
+        except ClientError as e:
+            if e.response.get('Error', {}).get('Code') in ('404', 'NoSuchKey', 'NotFound'):
+                return None
+            raise
+
+    def download(self, key, path):
+        with open(path, 'wb') as f:
+            self.client.download_fileobj(self.bucket, self.get_key(key), f, Config=self.transfer)
+
+    def upload(self, path, key):
+        self.client.upload_file(path, self.bucket, self.get_key(key), Config=self.transfer)
+
+
+def open_store(url, endpoint_url=None, jobs=4):
+    """Store from a folder path or s3://bucket/prefix url"""
+    if url.startswith('s3://'):
+        bucket, _, prefix = url[5:].partition('/')
+        if not bucket:
+            raise CcdlError('Invalid s3 store url: ' + url)
+        return S3Storage(bucket, prefix.strip('/') + '/' if prefix.strip('/') else '', endpoint_url, jobs)
+    if url.startswith('file://'):
+        url = url[7:]
+    os.makedirs(url, exist_ok=True)
+    return LocalStorage(url)
+
+
+def set_store(url, endpoint_url=None, jobs=4, evict=False):
+    global store, evict_cached
+    store = open_store(url, endpoint_url, jobs)
+    evict_cached = evict
+
+
+def get_store_errors():
+    """Exceptions of a store transfer, after which the CDN is used instead"""
+    if boto3 is None:
+        return (OSError, shutil.Error)
+    return (OSError, shutil.Error, BotoCoreError, ClientError)
+
+
+def get_store_size(key):
+    """Size of key in the store, None without store, if missing or on error"""
+    if store is None:
+        return None
+    try:
+        return store.get_size(key)
+    except get_store_errors() as e:
+        print('Query {} in {} store failed: {!r}'.format(key, store.name, e))
+        return None
+
+
+def fetch_from_store(key, path, size):
+    """Download key aside the cache path if the store has it with the expected size
+
+    Return the part file for commit_verified_file, None if the store cannot provide it.
+    """
+    if store is None:
+        return None
+    try:
+        stored_size = store.get_size(key)
+        if stored_size is None or (size and stored_size != size):
+            return None
+        if os.path.isfile(path) and os.path.getsize(path) == stored_size:
+            return None
+        remove_stale_parts(path)
+        part_path = get_part_path(path)
+        try:
+            store.download(key, part_path)
+        except BaseException:
+            if os.path.exists(part_path):
+                os.remove(part_path)
+            raise
+        return part_path
+    except get_store_errors() as e:
+        print('Fetch {} from {} store failed, use CDN: {!r}'.format(key, store.name, e))
+        return None
+
+
+def put_to_store(path, key):
+    """Upload a verified cache file unless the store already has it, return True if uploaded"""
+    if store is None:
+        return False
+    try:
+        if store.get_size(key) == os.path.getsize(path):
+            return False
+        store.upload(path, key)
+        return True
+    except get_store_errors() as e:
+        print('Upload {} to {} store failed: {!r}'.format(key, store.name, e))
+        return False
+
+
+def evict_from_cache(path, key):
+    """With eviction enabled, remove a cached file the store holds with the same size, return True if removed"""
+    if store is None or not evict_cached or not os.path.isfile(path):
+        return False
+    if get_store_size(key) != os.path.getsize(path):
+        return False
+    with file_lock(get_cache_lock(path)):
+        if os.path.isfile(path):
+            os.remove(path)
+    return True
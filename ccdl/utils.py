@@ -1,6 +1,30 @@
+import errno
+import gzip
+import hashlib
+import os
+import re
+import shutil
+import sys
+import threading
+import time
 import zipfile
+from contextlib import contextmanager
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+    import msvcrt
 
 DRIVER_XML_NAME = 'driver.xml'
+STALE_PART_AGE = 600
+
+pending_sync = set()
+pending_sync_lock = threading.Lock()
+
+
+class CcdlError(Exception):
+    """Failure of the current operation, the command line exits while the daemon fails only the job"""
 
 
 def question_y(question: str) -> bool:
@@ -19,6 +43,14 @@ def question_n(question: str) -> bool:
     return reply in ("y", "Y")
 
 
+def split_list(val, upper=False):
+    """Split a comma separated option value, None if empty"""
+    if not val:
+        return None
+    items = [v.strip().upper() if upper else v.strip() for v in val.split(',')]
+    return [v for v in items if v] or None
+
+
 def get_download_path(path):
     if path:
         if path.lower() == 'ask':
@@ -30,10 +62,11 @@ def get_download_path(path):
     return path
 
 
-def check_archive(path):
+def check_archive(path, name=None):
+    """Test the archive at path, name is the final file name when path is a part file"""
     ok = None
 
-    if path[-4:] == '.zip':
+    if (name or path)[-4:] == '.zip':
         print('checking zip archive ... ', end='', flush=True)
         if zipfile.is_zipfile(path):
             ok = zipfile.ZipFile(path).testzip() is None
@@ -45,3 +78,201 @@ def check_archive(path):
     elif ok is False:
         print('Error')
     return ok
+
+
+def preallocate(file, size):
+    """Reserve the final size of a file being written, fail early if the volume is full"""
+    if size > 0 and hasattr(os, 'posix_fallocate'):
+        try:
+            os.posix_fallocate(file.fileno(), 0, size)
+        except OSError as e:
+            if e.errno == errno.ENOSPC:
+                raise CcdlError('No space left to allocate {} bytes for {}'.format(size, file.name))
+
+
+def copy_file(src, dst):
+    """Copy file content into a preallocated destination"""
+    size = os.path.getsize(src)
+    with open(src, 'rb') as fsrc, open(dst, 'wb') as fdst:
+        preallocate(fdst, size)
+        if sys.platform.startswith('linux'):
+            offset = 0
+            while offset < size:
+                sent = os.sendfile(fdst.fileno(), fsrc.fileno(), offset, min(size - offset, 0x40000000))
+                if sent == 0:
+                    break
+                offset += sent
+            fdst.truncate(offset)
+        else:
+            shutil.copyfileobj(fsrc, fdst, 0x100000)
+
+
+def get_existing_path(path):
+    path = os.path.abspath(path)
+    while not os.path.exists(path):
+        path = os.path.dirname(path)
+    return path
+
+
+def check_disk_space(requirements, ignore=False):
+    """Check free space for {path: bytes}, paths on the same volume are summed"""
+    volumes = {}
+    for path, size in requirements.items():
+        if not path or not size:
+            continue
+        path = get_existing_path(path)
+        dev = os.stat(path).st_dev
+        volumes.setdefault(dev, [path, 0])[1] += size
+
+    ok = True
+    for path, size in volumes.values():
+        free = shutil.disk_usage(path).free
+        print('Space required on {}: {:.1f} MiB, free: {:.1f} MiB'.format(path, size / 0x100000, free / 0x100000))
+        if size > free:
+            ok = False
+    if not ok:
+        if ignore:
+            print('Warning: not enough disk space, continue anyway')
+        else:
+            raise CcdlError('Not enough disk space, exit')
+
+
+@contextmanager
+def file_lock(lock_path):
+    """Exclusive lock shared by threads and processes using the same lock file"""
+    with open(lock_path, 'a+b') as f:
+        if fcntl:
+            fcntl.flock(f.fileno(), fcntl.LOCK_EX)
+        else:
+            f.seek(0)
+            while True:
+                try:
+                    msvcrt.locking(f.fileno(), msvcrt.LK_LOCK, 1)
+                    break
+                except OSError:
+                    pass
+        try:
+            yield
+        finally:
+            if fcntl:
+                fcntl.flock(f.fileno(), fcntl.LOCK_UN)
+            else:
+                f.seek(0)
+                msvcrt.locking(f.fileno(), msvcrt.LK_UNLCK, 1)
+
+
+def get_file_digest(path):
+    """SHA-1 of the file content, unlike the mtime it survives a revalidation that touched the file"""
+    h = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(0x100000), b''):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def open_metadata(path, mode='rt'):
+    """Open a cached metadata file, decompressed while it is read if it is gzip compressed"""
+    if path.endswith('.gz'):
+        return gzip.open(path, mode, encoding=None if 'b' in mode else 'utf-8')
+    return open(path, mode, encoding=None if 'b' in mode else 'utf-8')
+
+
+def compress_file(src, path):
+    """Write a gzip compressed copy of src to path atomically"""
+    part_path = get_part_path(path)
+    try:
+        with open(src, 'rb') as f_in, gzip.open(part_path, 'wb', compresslevel=6) as f_out:
+            shutil.copyfileobj(f_in, f_out, 0x100000)
+    except BaseException:
+        if os.path.exists(part_path):
+            os.remove(part_path)
+        raise
+    commit_file(part_path, path)
+
+
+def get_lock_path(lock_dir, key):
+    """One of 256 lock files in lock_dir, keys sharing it are serialized but lock files do not pile up"""
+    return os.path.join(lock_dir, hashlib.sha1(key.encode('utf-8')).hexdigest()[:2] + '.lock')
+
+
+def remove_legacy_locks(lock_dir):
+    """Remove lock files named after the full hash of a path, written by older versions"""
+    try:
+        names = os.listdir(lock_dir)
+    except OSError:
+        return
+    for n in names:
+        if re.fullmatch(r'[0-9a-f]{40}\.lock', n):
+            try:
+                os.remove(os.path.join(lock_dir, n))
+            except OSError:
+                pass
+
+
+def get_part_path(path):
+    return '{}.part{}-{}'.format(path, os.getpid(), threading.get_ident())
+
+
+def is_process_running(pid):
+    if not fcntl:
+        # os.kill would terminate the process on Windows
+        return True
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+def remove_stale_parts(path):
+    """Remove part files of path left by killed processes
+
+    The pid may belong to another host sharing the folder, a part file is also kept while it is recently written.
+    """
+    dir_path, name = os.path.split(path)
+    try:
+        names = os.listdir(dir_path)
+    except OSError:
+        return
+    for n in names:
+        m = re.match(re.escape(name) + r'\.part(\d+)-\d+', n)
+        if not m or is_process_running(int(m.group(1))):
+            continue
+        part_path = os.path.join(dir_path, n)
+        try:
+            if time.time() - os.path.getmtime(part_path) >= STALE_PART_AGE:
+                print('Remove stale part file: ' + part_path)
+                os.remove(part_path)
+        except OSError:
+            pass
+
+
+def commit_file(part_path, path):
+    """Atomically move a completely written file into place, fsync is deferred to sync_pending_files"""
+    os.replace(part_path, path)
+    with pending_sync_lock:
+        pending_sync.add(path)
+
+
+def sync_pending_files():
+    """Flush files committed since the last call and their directories to disk"""
+    with pending_sync_lock:
+        paths = list(pending_sync)
+        pending_sync.clear()
+    dirs = set()
+    for path in paths:
+        try:
+            with open(path, 'rb') as f:
+                os.fsync(f.fileno())
+        except OSError:
+            continue
+        dirs.add(os.path.dirname(path))
+    if fcntl:
+        for d in dirs:
+            fd = os.open(d, os.O_RDONLY)
+            try:
+                os.fsync(fd)
+            finally:
+                os.close(fd)
@@ -1,6 +1,6 @@
 import os
 
-from ccdl.utils import DRIVER_XML_NAME
+from ccdl.utils import DRIVER_XML_NAME, CcdlError
 
 APPLICATIONS_PATH = 'C:\\Program Files\\Adobe'
 ADOBE_HDBOX_SETUP = 'C:\\Program Files\\Common Files\\Adobe\\Adobe Desktop Common\\HDBox\\Setup.exe'
@@ -27,22 +27,22 @@ echo Done
            script_name=SCRIPT_NAME)
 
 
-def get_platforms(target_arch=None):
+def get_platforms(target_arch=None, strict=True):
     if not target_arch:
         return ['win64', 'win32']
     elif target_arch == 'x86_64' or target_arch == 'x64':
         return ['win64', 'win32']
     elif target_arch == 'x86':
         return ['win32']
+    elif not strict:
+        return None
     else:
-        print('Invalid argument "{}" for {}'.format(target_arch, 'architecture'))
-        exit(1)
+        raise CcdlError('Invalid argument "{}" for {}'.format(target_arch, 'architecture'))
 
 
 def create_win_installer(app_name, dest, use_gui=False, icon_path=None):
     if use_gui:
-        print('GUI for installer on windows not supported.')
-        exit(1)
+        raise CcdlError('GUI for installer on windows not supported.')
     else:
         app_path = os.path.join(dest, app_name)
         os.makedirs(app_path, exist_ok=True)